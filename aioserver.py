@@ -0,0 +1,162 @@
+import io
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from http.client import parse_headers
+
+EXECUTOR_WORKERS = 32
+KEEPALIVE_TIMEOUT = 75
+MAX_KEEPALIVE_REQUESTS = 1000
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+BACKLOG = 1024
+# seconds requests in progress get to finish on shutdown, under the 30 s
+# after which the prefork supervisor kills a worker
+GRACEFUL_TIMEOUT = 25
+
+
+class AsyncHTTPServer(object):
+    """
+    HTTP/1.1 server on top of asyncio streams.
+
+    Connections are served by coroutines, so idle keep-alive clients cost
+    almost nothing. The application callable
+    ``app(command, path, headers, body) -> (code, headers, payload)`` is
+    synchronous (it goes down to the store), so it runs on a bounded thread
+    pool and a slow store call never stalls the event loop. Bodies without
+    a usable Content-Length or larger than max_body_size are not read, the
+    app gets None for them. On shutdown the listening socket is closed,
+    idle keep-alive connections are dropped and requests in progress get
+    up to graceful_timeout seconds to be answered.
+    """
+    server_version = "ScoringAPI/1.1"
+
+    def __init__(self, server_address, app, workers=EXECUTOR_WORKERS, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 sock=None, max_body_size=MAX_BODY_SIZE, max_requests=MAX_KEEPALIVE_REQUESTS,
+                 graceful_timeout=GRACEFUL_TIMEOUT):
+        self.server_address = server_address
+        self.app = app
+        self.max_body_size = max_body_size
+        self.sock = sock
+        self.loop = None
+        self.stopping = None
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        # connection task -> True while it is serving a request
+        self.connections = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def format_response(self, code, headers, payload, keep_alive):
+        head = [
+            "HTTP/1.1 %d %s" % (code, HTTPStatus(code).phrase),
+            "Server: %s" % self.server_version,
+            "Date: %s" % formatdate(usegmt=True),
+        ]
+        head.extend("%s: %s" % header for header in headers)
+        head.extend([
+            "Content-Length: %d" % len(payload),
+            "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+        ])
+        return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload
+
+    @staticmethod
+    def wants_keep_alive(version, headers):
+        connection = (headers.get("Connection") or "").lower()
+        if version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    async def read_request(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+        request_line, _, raw_headers = head.partition(b"\r\n")
+        command, path, version = request_line.decode("latin-1").split()
+        headers = parse_headers(io.BytesIO(raw_headers))
+        try:
+            length = int(headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if 0 <= length <= self.max_body_size:
+            data_string = await reader.readexactly(length) if length > 0 else b""
+            framed = True
+        else:
+            # the body is left unread, so the request is answered
+            # and the connection is dropped
+            data_string, framed = None, False
+        keep_alive = framed and self.wants_keep_alive(version, headers)
+        return command, path, headers, data_string, keep_alive
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        served = 0
+        try:
+            while True:
+                self.connections[task] = False
+                try:
+                    command, path, headers, data_string, keep_alive = await self.read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except (asyncio.LimitOverrunError, ValueError):
+                    writer.write(self.format_response(HTTPStatus.BAD_REQUEST, [], b"", False))
+                    break
+                self.connections[task] = True
+                if command in ("GET", "POST"):
+                    code, response_headers, payload = await loop.run_in_executor(
+                        self.executor, self.app, command, path, headers, data_string)
+                else:
+                    code, response_headers, payload = HTTPStatus.NOT_IMPLEMENTED, [], b""
+                served += 1
+                keep_alive = keep_alive and served < self.max_requests and not self.stopping.is_set()
+                writer.write(self.format_response(code, response_headers, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def drain(self):
+        """Drop idle connections, wait up to graceful_timeout for the ones answering a request."""
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        if not self.connections:
+            return
+        done, pending = await asyncio.wait(list(self.connections), timeout=self.graceful_timeout)
+        if pending:
+            logging.error("%s requests not finished in %ss, dropped" % (len(pending), self.graceful_timeout))
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if self.sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=self.sock, limit=MAX_HEADER_SIZE)
+        else:
+            host, port = self.server_address
+            server = await asyncio.start_server(self.handle_connection, host, port,
+                                                limit=MAX_HEADER_SIZE, backlog=BACKLOG)
+        async with server:
+            await self.stopping.wait()
+            server.close()
+            await self.drain()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """Stop accepting connections and drain the open ones; safe to call from another thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def server_close(self):
+        self.executor.shutdown(wait=False)
@@ -2,32 +2,52 @@
 # -*- coding: utf-8 -*-
 # https://pastebin.com/WpDpDfeX
 import abc
+import os
+import time
 import json
+import signal
+import socket
+import functools
+import threading
 import datetime
 import logging
 import hashlib
+import hmac
 import uuid
+import random
 import re
 from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
+import cache
+import codec
+import metrics
+import ratelimit
 import scoring
+import store
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
 OK = 200
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
+TOO_MANY_REQUESTS = 429
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
 UNKNOWN = 0
 MALE = 1
@@ -37,6 +57,19 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+MAX_BODY_SIZE = 1024 * 1024
+MAX_BATCH_SIZE = 10000
+# defaults of both engines; aioserver, prefork and asynclog are imported only by the options that use them
+EXECUTOR_WORKERS = 32
+KEEPALIVE_TIMEOUT = 75
+MAX_KEEPALIVE_REQUESTS = 1000
+# seconds requests in progress get to finish on shutdown, under the 30 s
+# after which the prefork supervisor kills a worker
+GRACEFUL_TIMEOUT = 25
+# longest deadline a client can ask for in X-Request-Timeout, seconds
+MAX_REQUEST_TIMEOUT = 60
+# longest wait for the shared rate limit buckets before the local ones stand in, seconds
+ADMISSION_TIMEOUT = 0.05
 
 
 class Field(object):
@@ -79,22 +112,51 @@ class PhoneField(Field):
             raise ValueError("Value is not a phone number. Must start with 7 and equal 11 digits")
 
 
+DATE_FORMAT = "%d.%m.%Y"
+DATE_CACHE_SIZE = 4096
+_today = [None, 0.0]
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    """
+    DD.MM.YYYY without strptime and its locale lock. Anything that is not
+    exactly in this shape still goes through strptime, so accepted values
+    and error messages stay the same.
+    """
+    # isdecimal() alone would also take non-ASCII digits, which strptime rejects
+    if len(value) == 10 and value.isascii() and value[2] == "." and value[5] == ".":
+        day, month, year = value[:2], value[3:5], value[6:]
+        if day.isdecimal() and month.isdecimal() and year.isdecimal():
+            try:
+                return datetime.datetime(int(year), int(month), int(day))
+            except ValueError:
+                pass
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+def today():
+    """datetime.today() refreshed once a day, at the local midnight."""
+    if time.time() >= _today[1]:
+        now = datetime.datetime.today()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+        _today[:] = [now, midnight.timestamp()]
+    return _today[0]
+
+
 class DateField(Field):
     def parse_validate(self, value):  # code here
         if isinstance(value, str):
-            _format = "%d.%m.%Y"
-            value = datetime.datetime.strptime(value, _format)
-            return value
+            return parse_date(value)
         raise ValueError("This is the incorrect date string format. It should be DD.MM.YYYY")
 
 
 class BirthDayField(DateField):
     def parse_validate(self, value):  # code here
-        _format = "%d.%m.%Y"
         if isinstance(value, str):
-            value = datetime.datetime.strptime(value, _format)
+            value = parse_date(value)
             older_man = value.year + 70
-            today_year = datetime.datetime.today().year
+            today_year = today().year
             if older_man < today_year:
                 raise ValueError("You are so old. Your age must be less than 70 ",
                                  str.split(str(self.__class__), ".")[1][:-2])
@@ -122,56 +184,109 @@ class ClientIDsField(Field):
         raise ValueError("Field must be a list type. ")
 
 
+# method name -> shared handler instance, filled by @register
+HANDLERS = {}
+
+
+def register(method, rate_limit=None, timeout=None):
+    """
+    Class decorator: one instance of the handler serves every call of
+    method, so handlers keep no per-request state. rate_limit (requests
+    per second per login) and timeout (seconds) describe the method to
+    the router.
+    """
+    def decorator(handler_cls):
+        handler = handler_cls()
+        handler.method = method
+        handler.rate_limit = rate_limit
+        handler.timeout = timeout
+        HANDLERS[method] = handler
+        return handler_cls
+    return decorator
+
+
 class RequestHandler(object):
+    method = None
+    rate_limit = None
+    timeout = None
+    request_type = None
+
     def validate_handle(self, request, arguments, ctx, store):
-        if not arguments.is_valid():
+        started = time.perf_counter()
+        valid = arguments.is_valid()
+        handled = time.perf_counter()
+        metrics.observe_stage("arguments", handled - started)
+        if not valid:
             return arguments.errfmt(), INVALID_REQUEST
-        return self.handle(request, arguments, ctx, store)
+        result = self.handle(request, arguments, ctx, store)
+        metrics.observe_stage("handle", time.perf_counter() - handled)
+        return result
 
-    def handle(self, request, arguments, ctx):
+    def handle(self, request, arguments, ctx, store):
         return {}, OK
 
 
+def compile_clean(fields):
+    """
+    Generate a clean() specialized for the given fields: one straight pass
+    over the request dict storing parsed values into slots, with error
+    messages prebuilt per field.
+    """
+    lines = ["def clean(self):",
+             "    request = self.request",
+             "    errors = self.errors"]
+    namespace = {}
+    for f in fields:
+        name = f.name
+        namespace["parse_" + name] = f.parse_validate
+        lines.append("    if %r in request:" % name)
+        lines.append("        value = request[%r]" % name)
+        if f.required and not f.nullable:
+            lines.append("        if not value:")
+            lines.append("            errors.append(%r)" % ("Error in %s. Required field must be non-nullable " % name))
+        lines.append("        try:")
+        lines.append("            self.%s = parse_%s(value)" % (name, name))
+        lines.append("        except ValueError as e:")
+        lines.append("            errors.append(%r + str(e))" % ("Error in validate field: %s. " % name))
+        lines.append("    else:")
+        if f.required:
+            lines.append("        errors.append(%r)" % ("Error in %s. This is Required field." % name))
+        lines.append("        self.%s = \"\"" % name)
+    if not fields:
+        lines.append("    pass")
+    exec("\n".join(lines), namespace)
+    return namespace["clean"]
+
+
 class RequestMeta(type):
     def __new__(mcs, name, bases, attrs):
         field_list = []
-        for k, v in attrs.items():
+        for k, v in list(attrs.items()):
             if isinstance(v, Field):
                 v.name = k
                 field_list.append(v)
+                # the field value lives in a slot of the same name
+                del attrs[k]
+        attrs.setdefault("__slots__", tuple(f.name for f in field_list))
+        if "clean" not in attrs:
+            attrs["clean"] = compile_clean(field_list)
         cls = super().__new__(mcs, name, bases, attrs)
         cls.fields = field_list
         return cls
 
 
 class Request(object, metaclass=RequestMeta):
+    __slots__ = ("errors", "request", "is_cleaned")
+
     def __init__(self, request):
         self.errors = []
         self.request = request
         self.is_cleaned = False
 
-    def clean(self):
-        for f in self.fields:  # code here
-            try:
-                name = f.name
-                req = f.required
-                has_name = name in self.request
-                if req and has_name:
-                    if not self.request[name] and not f.nullable:
-                        self.errors.append("Error in " + str(name) + ". Required field must be non-nullable ")
-                elif req and not has_name:
-                    self.errors.append("Error in " + str(name) + ". This is Required field.")
-                if has_name:
-                    parse = f.parse_validate(self.request[name])
-                    setattr(self, name, parse)
-                else:
-                    setattr(self, name, "")
-            except ValueError as e:
-                self.errors.append("Error in validate field: " + str(name) + ". " + str(e))
-
     def is_valid(self):
         if not self.is_cleaned:
             self.clean()
+            self.is_cleaned = True
         return not self.errors
 
     def errfmt(self):
@@ -183,12 +298,34 @@ class ClientsInterestsRequest(Request):
     date = DateField(required=False, nullable=True)
 
 
+@register("clients_interests")
 class ClientsInterestsHandler(RequestHandler):
     request_type = ClientsInterestsRequest
+    # response by response_key, None to resolve every call
+    responses = None
+
+    @staticmethod
+    def client_ids(arguments):
+        """client_ids without repeats in one order, numbers first, so the same question gets the same payload."""
+        return sorted(set(arguments.client_ids), key=lambda cid: (0, cid) if type(cid) is int else (1, repr(cid)))
+
+    @staticmethod
+    def response_key(arguments):
+        """Hash of the arguments with client_ids deduplicated and sorted: the same question, the same key."""
+        client_ids = ",".join(sorted(set(map(repr, arguments.client_ids))))
+        return hashlib.md5(("%s|%s" % (client_ids, arguments.date)).encode('utf-8')).hexdigest()
 
     def handle(self, request, arguments, ctx, store):
         ctx["nclients"] = len(arguments.client_ids)
-        return {cid: scoring.get_interests(cid) for cid in arguments.client_ids}, OK
+        # the ETag is the hash of the encoded payload, see MainHTTPHandler.process
+        ctx["etag"] = None
+        key = self.response_key(arguments) if self.responses is not None else None
+        response = self.responses.get(key) if key is not None else None
+        if response is None:
+            response = scoring.get_interests_many(self.client_ids(arguments), store, ctx.get("deadline"))
+            if key is not None:
+                self.responses.set(key, response)
+        return response, OK
 
 
 class OnlineScoreRequest(Request):
@@ -213,13 +350,17 @@ class OnlineScoreRequest(Request):
 
 
 
+@register("online_score")
 class OnlineScoreHandler(RequestHandler):
     request_type = OnlineScoreRequest
-    def handle(self, request, arguments, ctx, store):
-        score = scoring.get_score(
-                                  arguments.phone, arguments.email,
-                                  arguments.birthday, arguments.gender,
-                                  arguments.first_name, arguments.last_name)
+
+    @staticmethod
+    def score_args(arguments):
+        return (arguments.phone, arguments.email,
+                arguments.birthday, arguments.gender,
+                arguments.first_name, arguments.last_name)
+
+    def respond(self, request, arguments, ctx, score):
         arg = []
         if request.login == ADMIN_LOGIN:
             return {"score": 42}, OK
@@ -230,6 +371,10 @@ class OnlineScoreHandler(RequestHandler):
 
         return {"score": score}, OK
 
+    def handle(self, request, arguments, ctx, store):
+        score = scoring.get_score(*self.score_args(arguments), backend=store, deadline=ctx.get("deadline"))
+        return self.respond(request, arguments, ctx, score)
+
 
 class MethodRequest(Request):
     account = CharField(required=False, nullable=True)
@@ -243,92 +388,612 @@ class MethodRequest(Request):
         return self.login == ADMIN_LOGIN
 
 
+AUTH_CACHE_SIZE = 4096
+_admin_digest = [None, None]
+
+
+def admin_digest():
+    """Admin token for the current hour, hashed once per hour bucket."""
+    now = datetime.datetime.now()
+    bucket = (now.year, now.month, now.day, now.hour)
+    if _admin_digest[0] != bucket:
+        digest = hashlib.sha512(str(now.strftime("%Y%m%d%H") + ADMIN_SALT).encode('utf-8')).hexdigest()
+        _admin_digest[:] = [bucket, digest]
+    return _admin_digest[1]
+
+
+@functools.lru_cache(maxsize=AUTH_CACHE_SIZE)
+def user_digest(account, login):
+    return hashlib.sha512(str(account + login + SALT).encode('utf-8')).hexdigest()
+
+
 def check_auth(request):
     if request.is_admin:
-        digest = hashlib.sha512(
-            str(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode('utf-8')).hexdigest()
+        digest = admin_digest()
     else:
-        digest = hashlib.sha512(str(request.account + request.login + SALT).encode('utf-8')).hexdigest()
-    if digest == request.token:
+        digest = user_digest(request.account, request.login)
+    if isinstance(request.token, str) and hmac.compare_digest(digest.encode('utf-8'), request.token.encode('utf-8')):
         return True
     return False
 
 
+def check_token(item):
+    """check_auth of a decoded, not yet validated request, for the admission."""
+    login, account, token = item.get("login"), item.get("account"), item.get("token")
+    if login == ADMIN_LOGIN:
+        digest = admin_digest()
+    elif isinstance(login, str) and isinstance(account, str):
+        digest = user_digest(account, login)
+    else:
+        return False
+    return isinstance(token, str) and hmac.compare_digest(digest.encode('utf-8'), token.encode('utf-8'))
+
+
 def method_handler(request, ctx, store):
-    methods_map = {
-        "online_score": OnlineScoreHandler,
-        "clients_interests": ClientsInterestsHandler,
-    }
+    started = time.perf_counter()
     method_request = MethodRequest(request["body"])
-    if not method_request.is_valid():
+    valid = method_request.is_valid()
+    validated = time.perf_counter()
+    metrics.observe_stage("validate", validated - started)
+    if not valid:
         return method_request.errfmt(), INVALID_REQUEST
-    if not check_auth(method_request):
+    authenticated = check_auth(method_request)
+    metrics.observe_stage("auth", time.perf_counter() - validated)
+    if not authenticated:
         return None, FORBIDDEN
-    handler_cls = methods_map.get(method_request.method)
-    if not handler_cls:
+    handler = HANDLERS.get(method_request.method)
+    if not handler:
         return "Method Not Found", NOT_FOUND
-    response, code = handler_cls().validate_handle(method_request,
-                                                   handler_cls.request_type(method_request.arguments),
-                                                   ctx, store)
-    return response, code
+    ctx["method"] = method_request.method
+    if handler.timeout is not None:
+        ctx["deadline"] = store_deadline(ctx.get("deadline"), handler.timeout)
+    return handler.validate_handle(method_request, handler.request_type(method_request.arguments), ctx, store)
+
+
+def store_deadline(deadline, timeout):
+    return store.Deadline.earliest(deadline, timeout)
+
+
+def batch_item(request, deadline, backend):
+    """method_handler for one batch item, its failures answer the item only."""
+    try:
+        return method_handler(request, {"deadline": deadline}, backend)
+    except store.DeadlineExceeded:
+        return "Deadline exceeded", GATEWAY_TIMEOUT
+    except store.StoreUnavailable as e:
+        logging.error("Store error: %s" % e)
+        return "Store is unavailable", INTERNAL_ERROR
+    except Exception as e:
+        logging.exception("Unexpected error: %s" % e)
+        return None, INTERNAL_ERROR
+
+
+def batch_handler(request, ctx, store):
+    """
+    Many method requests in one call. Every item is validated and
+    authenticated on its own (auth once per distinct credentials),
+    online_score items share one bulk cache lookup. Returns a list of
+    per-item responses in the shape of single calls. An item that fails
+    (out of time, store unavailable) answers GATEWAY_TIMEOUT or
+    INTERNAL_ERROR on its own, the others are still returned.
+    """
+    items = request["body"]
+    if not isinstance(items, list):
+        return "Batch must be an array of method requests", INVALID_REQUEST
+    if len(items) > MAX_BATCH_SIZE:
+        return "Batch is limited to %s requests" % MAX_BATCH_SIZE, INVALID_REQUEST
+    results = [None] * len(items)
+    authenticated = {}
+    scored = []
+    score_handler = HANDLERS["online_score"]
+    deadline = ctx.get("deadline")
+    for i, body in enumerate(items):
+        if not isinstance(body, dict):
+            results[i] = "Batch item must be a method request", INVALID_REQUEST
+            continue
+        if body.get("method") != "online_score":
+            results[i] = batch_item({"body": body, "headers": request["headers"]}, deadline, store)
+            continue
+        method_request = MethodRequest(body)
+        if not method_request.is_valid():
+            results[i] = method_request.errfmt(), INVALID_REQUEST
+            continue
+        credentials = (method_request.account, method_request.login, method_request.token)
+        if credentials not in authenticated:
+            authenticated[credentials] = check_auth(method_request)
+        if not authenticated[credentials]:
+            results[i] = None, FORBIDDEN
+            continue
+        arguments = OnlineScoreRequest(method_request.arguments)
+        if not arguments.is_valid():
+            results[i] = arguments.errfmt(), INVALID_REQUEST
+            continue
+        scored.append((i, method_request, arguments))
+    scores = scoring.get_scores([score_handler.score_args(arguments) for _, _, arguments in scored], store, deadline)
+    for (i, method_request, arguments), score in zip(scored, scores):
+        results[i] = score_handler.respond(method_request, arguments, {}, score)
+    ctx["nrequests"] = len(items)
+    return [format_response(response, code) for response, code in results], OK
+
+
+def format_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    # @TODO: return errors as array
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in two writes, with Nagle on the body of a
+    # keep-alive response waits for the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+    # idle keep-alive connections are dropped after timeout seconds
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests = MAX_KEEPALIVE_REQUESTS
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
     store = None
-
-    def get_request_id(self, headers):
+    admission = ratelimit.Admission()
+    codec = codec.JSONCodec()
+    max_body_size = MAX_BODY_SIZE
+    # share of request bodies written to the log and how much of each, None for all of it
+    log_sample = 1.0
+    log_body_size = None
+    # seconds a request may spend, None for no deadline; X-Request-Timeout can only shorten it
+    request_timeout = None
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        # between requests: a stopping server closes the connection instead of waiting for the next one
+        track = getattr(self.server, "track", None)
+        if track is not None and not track(self.request, False):
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def parse_request(self):
+        track = getattr(self.server, "track", None)
+        if track is not None:
+            track(self.request, True)
+        return super().parse_request()
+
+    @staticmethod
+    def get_request_id(headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
-    def do_POST(self):
+    @classmethod
+    def body_length(cls, headers):
+        """Declared body size and OK, or None and the code to reject the request with unread."""
+        try:
+            length = int(headers['Content-Length'])
+        except (TypeError, ValueError):
+            return None, BAD_REQUEST
+        if length < 0:
+            return None, BAD_REQUEST
+        if length > cls.max_body_size:
+            return None, REQUEST_ENTITY_TOO_LARGE
+        return length, OK
+
+    @classmethod
+    def request_deadline(cls, headers):
+        timeout = cls.request_timeout
+        try:
+            requested = float(headers.get("X-Request-Timeout"))
+        except (TypeError, ValueError):
+            requested = None
+        # nan, inf and huge values are not budgets, they would overflow the socket timeouts
+        if requested is not None and 0 < requested <= MAX_REQUEST_TIMEOUT and (timeout is None or requested < timeout):
+            timeout = requested
+        return store.Deadline(timeout) if timeout is not None else None
+
+    @classmethod
+    def log_body(cls, data_string):
+        if cls.log_body_size is None or len(data_string) <= cls.log_body_size:
+            return data_string
+        return b"%s... (%d bytes)" % (data_string[:cls.log_body_size], len(data_string))
+
+    @staticmethod
+    def etag_matches(etag, if_none_match):
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # weak comparison, as If-None-Match asks for
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    @classmethod
+    def process(cls, path, headers, data_string, response_headers=None):
+        """
+        Route a request body and return the status code with the encoded
+        response. data_string is None when the transport did not read the
+        body, the code then comes from body_length. A response with an ETag
+        gets it appended to response_headers, and is NOT_MODIFIED with an
+        empty payload when it matches If-None-Match.
+        """
+        started = time.perf_counter()
         response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
+        context = {"request_id": cls.get_request_id(headers)}
+        deadline = cls.request_deadline(headers)
+        if deadline is not None:
+            context["deadline"] = deadline
         request = None
-        try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except:
-            code = BAD_REQUEST
+        route = path.strip("/")
+        if data_string is None:
+            _, code = cls.body_length(headers)
+            if code == OK:
+                code = BAD_REQUEST
+        else:
+            try:
+                request = cls.codec.loads(data_string)
+            except:
+                code = BAD_REQUEST
+            metrics.observe_stage("decode", time.perf_counter() - started)
 
         if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
+            if cls.log_sample >= 1 or random.random() < cls.log_sample:
+                logging.info("%s: %s %s", path, cls.log_body(data_string), context["request_id"])
+            rejected = None
+            if route not in cls.router:
+                code = NOT_FOUND
+            elif cls.admission.active:
+                rejected = cls.admission.admit(request, store_deadline(deadline, ADMISSION_TIMEOUT))
+            if rejected:
+                response, code = "Rejected by %s limit" % rejected, TOO_MANY_REQUESTS
+            elif route in cls.router:
                 try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
+                    response, code = cls.router[route]({"body": request, "headers": headers}, context, cls.store)
+                except store.DeadlineExceeded as e:
+                    logging.error("Deadline exceeded: %s", e)
+                    response, code = "Deadline exceeded", GATEWAY_TIMEOUT
+                except store.StoreUnavailable as e:
+                    logging.error("Store error: %s" % e)
+                    response, code = "Store is unavailable", INTERNAL_ERROR
                 except Exception as e:
                     logging.exception("Unexpected error: %s" % e)
                     code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+                finally:
+                    cls.admission.release()
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            # @TODO: return errors as array
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        r = format_response(response, code)
         context.update(r)
+        encoding = time.perf_counter()
+        payload = cls.codec.dumps(r)
+        if code == OK and "etag" in context:
+            # md5 of the bytes already encoded, the handler answers in a stable order
+            context["etag"] = '"%s"' % hashlib.md5(payload).hexdigest()
+            if response_headers is not None:
+                response_headers.append(("ETag", context["etag"]))
+            if cls.etag_matches(context["etag"], headers.get("If-None-Match")):
+                payload, code = b"", NOT_MODIFIED
+                context.update(format_response(None, code))
+        metrics.observe_stage("encode", time.perf_counter() - encoding)
         logging.info(context)
-        self.wfile.write(json.dumps(r).encode(encoding='utf_8'))
+        finished = time.perf_counter()
+        # ctx["method"] is set only for registered methods, unknown routes share one label
+        metrics.observe_request(route if route in cls.router else metrics.OTHER, context.get("method", ""),
+                                code, finished - started)
+        return code, payload
+
+    @classmethod
+    def dispatch(cls, command, path, headers, data_string):
+        """Entry point of both engines: status code, response headers and payload."""
+        if command == "POST":
+            response_headers = [("Content-Type", "application/json")]
+            code, payload = cls.process(path, headers, data_string, response_headers)
+            return code, response_headers, payload
+        if path.strip("/") == "metrics":
+            return OK, [("Content-Type", metrics.CONTENT_TYPE)], metrics.REGISTRY.render()
+        return NOT_FOUND, [("Content-Type", "application/json")], cls.codec.dumps(format_response(None, NOT_FOUND))
+
+    def respond(self, code, headers, payload):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        stopping = getattr(self.server, "stopping", False)
+        if self.close_connection or self.requests_served >= self.max_requests or stopping:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.requests_served += 1
+        self.respond(*self.dispatch("GET", self.path, self.headers, None))
+
+    def do_POST(self):
+        self.requests_served += 1
+        length, code = self.body_length(self.headers)
+        data_string = self.rfile.read(length) if code == OK else None
+        if data_string is None:
+            # the unread body would be taken for the next request
+            self.close_connection = True
+        self.respond(*self.dispatch("POST", self.path, self.headers, data_string))
+        return
+
+
+def redis_instances(stats, labels=()):
+    """(labels, stats) of every Redis instance behind the store, shards labelled by name."""
+    if "shards" in stats:
+        for name, shard in sorted(stats["shards"].items()):
+            yield from redis_instances(shard, labels + (("shard", name),))
+    elif "pool" in stats:
+        yield labels, stats
+
+
+def store_metrics():
+    """Local cache, single-flight, interests catalog, circuit breaker and Redis pool counters for /metrics."""
+    stats = scoring.stats()
+    cache = stats["local_cache"]
+    for name in ("hits", "misses", "evictions"):
+        family = "scoring_api_local_cache_%s_total" % name
+        yield family, "counter", [(family, (), cache[name])]
+    yield "scoring_api_local_cache_size", "gauge", [("scoring_api_local_cache_size", (), cache["size"])]
+    yield "scoring_api_score_coalesced_total", "counter", [
+        ("scoring_api_score_coalesced_total", (), stats["single_flight"]["shared"])]
+    yield "scoring_api_score_refreshes_in_flight", "gauge", [
+        ("scoring_api_score_refreshes_in_flight", (), stats["refresh"]["in_flight"])]
+    yield "scoring_api_interests_catalog_size", "gauge", [
+        ("scoring_api_interests_catalog_size", (), stats["interests"]["size"])]
+    yield "scoring_api_interests_catalog_reloads_total", "counter", [
+        ("scoring_api_interests_catalog_reloads_total", (), stats["interests"]["reloads"])]
+    instances = list(redis_instances(stats["store"]))
+    if not instances:
+        return
+    yield "scoring_api_redis_circuit_open", "gauge", [
+        ("scoring_api_redis_circuit_open", labels, int(redis_stats["breaker"] != store.CLOSED))
+        for labels, redis_stats in instances]
+    for kind, names in (("gauge", ("in_use", "idle", "max_connections")),
+                        ("counter", ("created", "destroyed", "timeouts"))):
+        for name in names:
+            family = "scoring_api_redis_pool_%s" % name + ("_total" if kind == "counter" else "")
+            yield family, kind, [(family, labels, redis_stats["pool"][name]) for labels, redis_stats in instances]
+    family = "scoring_api_redis_pool_wait_seconds"
+    samples = []
+    for labels, redis_stats in instances:
+        pool, cumulative = redis_stats["pool"], 0
+        for bound, count in pool["wait_buckets"]:
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((family + "_bucket", labels + (("le", le),), cumulative))
+        samples.append((family + "_sum", labels, repr(pool["wait_sum"])))
+        samples.append((family + "_count", labels, cumulative))
+    yield family, "histogram", samples
+
+
+def admission_metrics():
+    rejected = MainHTTPHandler.admission.rejected
+    family = "scoring_api_rejected_total"
+    yield family, "counter", [(family, (("reason", reason),), count) for reason, count in sorted(rejected.items())]
+
+
+def response_cache_metrics():
+    responses = HANDLERS["clients_interests"].responses
+    if responses is None:
         return
+    stats = responses.stats()
+    for name in ("hits", "misses"):
+        family = "scoring_api_response_cache_%s_total" % name
+        yield family, "counter", [(family, (), stats[name])]
+
+
+metrics.REGISTRY.collectors.append(store_metrics)
+metrics.REGISTRY.collectors.append(admission_metrics)
+metrics.REGISTRY.collectors.append(response_cache_metrics)
+
+
+class GracefulHTTPServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer that drains on stop: after shutdown() and
+    server_close() idle keep-alive connections are closed and requests in
+    progress get up to graceful_timeout seconds to be answered.
+    """
+    graceful_timeout = GRACEFUL_TIMEOUT
+
+    def __init__(self, *args, **kwargs):
+        self.stopping = False
+        # request socket -> [handler thread, True while answering a request]
+        self.connections = {}
+        self._connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address), daemon=True)
+        with self._connections_lock:
+            self.connections[request] = [thread, False]
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._connections_lock:
+                self.connections.pop(request, None)
+
+    def track(self, request, busy):
+        """Record whether the connection is answering a request; False once the server is stopping."""
+        with self._connections_lock:
+            entry = self.connections.get(request)
+            if entry is not None:
+                entry[1] = busy
+        return not self.stopping
+
+    def shutdown(self):
+        self.stopping = True
+        super().shutdown()
+
+    def server_close(self):
+        self.stopping = True
+        super().server_close()
+        deadline = time.monotonic() + self.graceful_timeout
+        with self._connections_lock:
+            connections = list(self.connections.items())
+        for request, (thread, busy) in connections:
+            if not busy:
+                try:
+                    # wakes the handler waiting for the next request on this connection
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        for request, (thread, busy) in connections:
+            thread.join(max(0, deadline - time.monotonic()))
+        unfinished = sum(thread.is_alive() for request, (thread, busy) in connections)
+        if unfinished:
+            logging.error("%s requests not finished in %ss, dropped" % (unfinished, self.graceful_timeout))
+
+
+def make_server(opts, sock=None):
+    address = ("localhost", opts.port)
+    if opts.engine == "asyncio":
+        import aioserver
+        return aioserver.AsyncHTTPServer(address, MainHTTPHandler.dispatch, workers=opts.threads, sock=sock,
+                                         max_body_size=MainHTTPHandler.max_body_size,
+                                         keepalive_timeout=MainHTTPHandler.timeout,
+                                         max_requests=MainHTTPHandler.max_requests,
+                                         graceful_timeout=GRACEFUL_TIMEOUT)
+    # keep-alive connections hold their thread between requests
+    if sock is None:
+        return GracefulHTTPServer(address, MainHTTPHandler)
+    server = GracefulHTTPServer(address, MainHTTPHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    return server
+
+
+def store_options(opts):
+    return {
+        "max_connections": opts.pool_size,
+        "pool_timeout": opts.pool_timeout,
+        "idle_timeout": opts.pool_idle,
+    }
+
+
+def make_backend(opts):
+    """Store backend from the options: memory, one Redis or Redis shards (host:port,host:port)."""
+    if opts.store == "memory":
+        return store.MemoryBackend(names=opts.interests.split(",") if opts.interests else None)
+    if not opts.shards:
+        return store.RedisBackend(**store_options(opts))
+    shards = []
+    for address in opts.shards.split(","):
+        host, _, port = address.strip().rpartition(":")
+        shards.append(store.RedisBackend(host=host, port=int(port), **store_options(opts)))
+    return store.ShardedBackend(shards)
+
+
+def configure(opts):
+    """App factory: settings of the handler and of the score cache from the options, no connections yet."""
+    MainHTTPHandler.codec = codec.get_codec(opts.codec)
+    MainHTTPHandler.max_body_size = opts.max_body
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_requests = opts.max_requests
+    MainHTTPHandler.log_sample = opts.log_sample
+    MainHTTPHandler.log_body_size = opts.log_body_size
+    MainHTTPHandler.request_timeout = opts.deadline
+    if opts.response_cache_ttl > 0:
+        HANDLERS["clients_interests"].responses = cache.LRUCache(maxsize=opts.response_cache_size,
+                                                                 ttl=opts.response_cache_ttl)
+    scoring.init_policy(ttl=scoring.SCORE_TTL, jitter=opts.cache_jitter, stale=opts.cache_stale, beta=opts.cache_beta)
+    MainHTTPHandler.admission = ratelimit.Admission(
+        login_rate=opts.rate_limit, account_rate=opts.account_rate_limit, burst=opts.rate_burst,
+        max_client_ids=opts.max_client_ids, max_concurrency=opts.max_concurrency,
+        method_rates={method: handler.rate_limit for method, handler in HANDLERS.items() if handler.rate_limit},
+        shared_errors=(store.StoreUnavailable,), authenticate=check_token)
+    return MainHTTPHandler
+
+
+def setup_process(opts):
+    """
+    Startup hook of a serving process, after the fork in the worker mode:
+    the store is created here, and with --warmup connected before the
+    first request is accepted.
+    """
+    if opts.log_queue > 0:
+        import asynclog
+        asynclog.install(queue_size=opts.log_queue)
+    # every process gets its own Redis pool
+    MainHTTPHandler.store = scoring.init_store(make_backend(opts))
+    if opts.rate_limit_shared:
+        MainHTTPHandler.admission.shared = MainHTTPHandler.store
+    if opts.warmup > 0:
+        started = time.perf_counter()
+        try:
+            scoring.warm_up(opts.warmup)
+        except store.StoreUnavailable as e:
+            logging.error("Store warm-up failed: %s" % e)
+        else:
+            logging.info("Store warmed up in %.3fs" % (time.perf_counter() - started))
+
+
+def run_worker(opts, sock):
+    setup_process(opts)
+    server = make_server(opts, sock)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info("Worker %s serving" % os.getpid())
+    try:
+        server.serve_forever()
+        server.server_close()
+    finally:
+        if opts.log_queue > 0:
+            # the supervisor ends the worker with os._exit, atexit does not run
+            import asynclog
+            asynclog.stop()
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-e", "--engine", action="store", type="choice", choices=["thread", "asyncio"], default="thread")
+    op.add_option("-t", "--threads", action="store", type=int, default=EXECUTOR_WORKERS)
+    op.add_option("-w", "--workers", action="store", type=int, default=0)
+    op.add_option("-c", "--codec", action="store", type="choice", choices=["auto"] + list(codec.CODECS),
+                  default="auto")
+    op.add_option("-b", "--max-body", action="store", type=int, default=MAX_BODY_SIZE)
+    op.add_option("-k", "--keepalive-timeout", action="store", type=int, default=KEEPALIVE_TIMEOUT)
+    op.add_option("-m", "--max-requests", action="store", type=int, default=MAX_KEEPALIVE_REQUESTS)
+    op.add_option("-s", "--store", action="store", type="choice", choices=["redis", "memory"], default="redis")
+    op.add_option("--shards", action="store", default=None)
+    op.add_option("--interests", action="store", default=None)
+    op.add_option("--warmup", action="store", type=int, default=0)
+    op.add_option("--deadline", action="store", type=float, default=None)
+    op.add_option("--pool-size", action="store", type=int, default=store.REDIS_AUTH['POOL_SIZE'])
+    op.add_option("--pool-timeout", action="store", type=float, default=store.REDIS_AUTH['POOL_TIMEOUT'])
+    op.add_option("--pool-idle", action="store", type=float, default=store.REDIS_AUTH['POOL_IDLE'])
+    op.add_option("--cache-jitter", action="store", type=float, default=0.1)
+    op.add_option("--cache-stale", action="store", type=int, default=60)
+    op.add_option("--cache-beta", action="store", type=float, default=1.0)
+    op.add_option("--response-cache-ttl", action="store", type=float, default=0)
+    op.add_option("--response-cache-size", action="store", type=int, default=10000)
+    op.add_option("--rate-limit", action="store", type=float, default=None)
+    op.add_option("--account-rate-limit", action="store", type=float, default=None)
+    op.add_option("--rate-burst", action="store", type=float, default=None)
+    op.add_option("--rate-limit-shared", action="store_true", default=False)
+    op.add_option("--max-concurrency", action="store", type=int, default=None)
+    op.add_option("--max-client-ids", action="store", type=int, default=None)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-queue", action="store", type=int, default=0)
+    op.add_option("--log-sample", action="store", type=float, default=1.0)
+    op.add_option("--log-body-size", action="store", type=int, default=None)
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    configure(opts)
+    logging.info("Starting %s server at %s with %s codec" % (opts.engine, opts.port, MainHTTPHandler.codec.name))
+    if opts.workers > 0:
+        import prefork
+        listen_sock = prefork.listen(("localhost", opts.port))
+        prefork.Supervisor(functools.partial(run_worker, opts, listen_sock), opts.workers).run()
+        listen_sock.close()
+    else:
+        setup_process(opts)
+        server = make_server(opts)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
@@ -0,0 +1,126 @@
+import queue
+import atexit
+import logging
+import threading
+
+import metrics
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 256
+_STOP = object()
+# (logger, handler, writer) of every install() in the process
+_installed = []
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a bounded queue as they are, formatting happens in the
+    writer thread. Records that do not fit are dropped and counted, so a
+    slow disk never blocks a request.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def handle(self, record):
+        # no handler lock, the queue has its own
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchWriter(threading.Thread):
+    """Drains the queue in batches and writes each batch to the target handlers with one flush."""
+
+    def __init__(self, source, targets, batch_size=BATCH_SIZE):
+        super().__init__(name="log-writer", daemon=True)
+        self.source = source
+        self.targets = targets
+        self.batch_size = batch_size
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.source.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.source.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not _STOP]
+            for target in self.targets:
+                self.write(target, batch)
+
+    def write(self, target, batch):
+        records = [record for record in batch if record.levelno >= target.level]
+        stream = getattr(target, "stream", None)
+        if stream is None:
+            # handle() applies the filters of the target itself
+            for record in records:
+                target.handle(record)
+            return
+        lines = []
+        for record in records:
+            if not target.filter(record):
+                continue
+            try:
+                lines.append(target.format(record) + getattr(target, "terminator", "\n"))
+            except Exception:
+                target.handleError(record)
+        if not lines:
+            return
+        with target.lock:
+            try:
+                stream.write("".join(lines))
+                target.flush()
+            except Exception:
+                target.handleError(batch[-1])
+
+    def stop(self):
+        self.source.queue.put(_STOP)
+        self.join()
+
+
+def install(queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, logger=None):
+    """
+    Move the handlers of logger (root by default) behind a bounded queue
+    drained by a background writer. Call in the process that serves
+    requests, after any fork; a process leaving through os._exit, which
+    skips atexit, calls stop() first.
+    """
+    logger = logger or logging.getLogger()
+    handler = QueueHandler(queue_size)
+    writer = BatchWriter(handler, list(logger.handlers), batch_size)
+    for target in writer.targets:
+        logger.removeHandler(target)
+    logger.addHandler(handler)
+    writer.start()
+    if not _installed:
+        atexit.register(stop)
+    _installed.append((logger, handler, writer))
+    metrics.REGISTRY.collectors.append(lambda: [
+        ("scoring_api_log_dropped_total", "counter", [("scoring_api_log_dropped_total", (), handler.dropped)]),
+        ("scoring_api_log_queue_size", "gauge", [("scoring_api_log_queue_size", (), handler.queue.qsize())]),
+    ])
+    return handler, writer
+
+
+def stop():
+    """Give the handlers back to their loggers and write out what is queued."""
+    while _installed:
+        logger, handler, writer = _installed.pop()
+        logger.removeHandler(handler)
+        for target in writer.targets:
+            logger.addHandler(target)
+        writer.stop()
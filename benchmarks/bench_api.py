@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency benchmark of the API entry points: method_handler
+called directly, and MainHTTPHandler over real sockets on the thread and
+asyncio engines, with keep-alive clients. Redis is replaced by an
+in-process store.MemoryBackend, so the numbers measure the service itself. Requests are
+a weighted mix of online_score, clients_interests and admin calls over a
+fixed population of users, so the caches see a realistic hit ratio.
+
+Results are printed and written as JSON; pass a previous run to compare:
+
+    python benchmarks/bench_api.py -n 20000 -o before.json
+    python benchmarks/bench_api.py -n 20000 -o after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import platform
+import threading
+import subprocess
+from http.client import HTTPConnection
+from optparse import OptionParser, Values
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api
+import scoring
+import store
+
+TARGETS = ("direct", "thread", "asyncio")
+# share of each kind of request in the mix
+MIX = (("online_score", 0.7), ("clients_interests", 0.2), ("admin", 0.1))
+INTERESTS = ("cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus")
+
+
+def make_backend():
+    return store.MemoryBackend(names=INTERESTS)
+
+
+def make_body(kind, rnd, users):
+    user = rnd.randrange(users)
+    if kind == "clients_interests":
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                "arguments": {"client_ids": [rnd.randrange(users) for _ in range(rnd.randint(1, 10))],
+                              "date": "20.07.2017"}}
+    else:
+        body = {"account": "horns&hoofs", "login": api.ADMIN_LOGIN if kind == "admin" else "h&f",
+                "method": "online_score",
+                "arguments": {"phone": "7917%07d" % user, "email": "user%d@otus.ru" % user,
+                              "first_name": "a", "last_name": "b%d" % user,
+                              "birthday": "01.01.1990", "gender": user % 3}}
+    if kind == "admin":
+        body["token"] = api.admin_digest()
+    else:
+        body["token"] = api.user_digest(body["account"], body["login"])
+    return body
+
+
+def make_payloads(number, users, seed):
+    rnd = random.Random(seed)
+    kinds, weights = zip(*MIX)
+    return [make_body(kind, rnd, users) for kind in rnd.choices(kinds, weights, k=number)]
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def summarize(target, latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        "target": target,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def run_direct(payloads, opts):
+    latencies, errors = [], 0
+    clock = time.perf_counter
+    started = clock()
+    for body in payloads:
+        t = clock()
+        response, code = api.method_handler({"body": body, "headers": {}}, {}, None)
+        latencies.append(clock() - t)
+        errors += code != api.OK
+    return summarize("direct", latencies, clock() - started, errors)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_server(engine, payloads, opts):
+    server_opts = Values({"port": free_port(), "engine": engine, "threads": opts.threads})
+    server = api.make_server(server_opts)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", server_opts.port)).close()
+            break
+        except OSError:
+            time.sleep(0.02)
+
+    bodies = [json.dumps(body).encode("utf-8") for body in payloads]
+    latencies, errors = [], [0]
+
+    def client(chunk):
+        conn = HTTPConnection("localhost", server_opts.port, timeout=10)
+        own = []
+        clock = time.perf_counter
+        for body in chunk:
+            t = clock()
+            conn.request("POST", "/method/", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            own.append(clock() - t)
+            if resp.status != api.OK:
+                errors[0] += 1
+        conn.close()
+        latencies.extend(own)
+
+    clients = [threading.Thread(target=client, args=(bodies[i::opts.concurrency],))
+               for i in range(opts.concurrency)]
+    started = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+    return summarize(engine, latencies, elapsed, errors[0])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, path):
+    with open(path) as f:
+        previous = {result["target"]: result for result in json.load(f)["results"]}
+    print("\ncompared to %s" % path)
+    print("%-10s %12s %10s %10s" % ("target", "rps", "p50", "p99"))
+    for result in report["results"]:
+        old = previous.get(result["target"])
+        if old:
+            print("%-10s %11.2fx %9.2fx %9.2fx" % (result["target"], result["rps"] / old["rps"],
+                                                  result["p50_ms"] / old["p50_ms"],
+                                                  result["p99_ms"] / old["p99_ms"]))
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000)
+    op.add_option("-u", "--users", action="store", type=int, default=1000)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-t", "--threads", action="store", type=int, default=8)
+    op.add_option("--targets", action="store", default=",".join(TARGETS))
+    op.add_option("--seed", action="store", type=int, default=0)
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("--compare", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.disable(logging.CRITICAL)
+    # http.server writes an access line to stderr for every request
+    api.MainHTTPHandler.log_message = lambda self, format, *args: None
+
+    payloads = make_payloads(opts.number, opts.users, opts.seed)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "codec": api.MainHTTPHandler.codec.name,
+        "options": {"number": opts.number, "users": opts.users, "concurrency": opts.concurrency,
+                    "mix": dict(MIX)},
+        "results": [],
+    }
+    print("%-10s %10s %8s %10s %10s %10s" % ("target", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for target in opts.targets.split(","):
+        # every target starts from cold caches
+        scoring.local_cache.clear()
+        scoring.init_store(make_backend())
+        if target == "direct":
+            result = run_direct(payloads, opts)
+        else:
+            result = run_server(target, payloads, opts)
+        report["results"].append(result)
+        print("%-10s %10.1f %8d %10.3f %10.3f %10.3f" % (target, result["rps"], result["errors"],
+                                                         result["p50_ms"], result["p95_ms"], result["p99_ms"]))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if opts.compare:
+        compare(report, opts.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Authentication overhead benchmark: check_auth with cached digests against
+hashing on every call, and method_handler on requests that stop right
+after authentication (no store work), in calls per second.
+
+    python benchmarks/bench_auth.py -n 100000
+"""
+import os
+import sys
+import timeit
+import hashlib
+import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api
+
+
+def legacy_check_auth(request):
+    """check_auth as it was before the digest cache."""
+    if request.is_admin:
+        digest = hashlib.sha512(
+            str(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha512(str(request.account + request.login + api.SALT).encode('utf-8')).hexdigest()
+    return digest == request.token
+
+
+def make_request(login, method="unknown_method"):
+    request = {"account": "horns&hoofs", "login": login, "method": method, "arguments": {}}
+    if login == api.ADMIN_LOGIN:
+        request["token"] = api.admin_digest()
+    else:
+        request["token"] = api.user_digest(request["account"], login)
+    return request
+
+
+def rate(func, number):
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=50000)
+    (opts, args) = op.parse_args()
+    print("%-30s %15s %15s %8s" % ("case", "legacy/s", "cached/s", "speedup"))
+    for login in ("h&f", api.ADMIN_LOGIN):
+        request = api.MethodRequest(make_request(login))
+        request.is_valid()
+        assert api.check_auth(request) and legacy_check_auth(request)
+        legacy = rate(lambda: legacy_check_auth(request), opts.number)
+        cached = rate(lambda: api.check_auth(request), opts.number)
+        print("%-30s %15.0f %15.0f %7.2fx" % ("check_auth " + login, legacy, cached, cached / legacy))
+
+    print("\n%-30s %15s" % ("method_handler", "calls/s"))
+    cases = {
+        "valid token, unknown method": make_request("h&f"),
+        "admin, unknown method": make_request(api.ADMIN_LOGIN),
+        "bad token": dict(make_request("h&f"), token="bad"),
+    }
+    for name, body in cases.items():
+        request = {"body": body, "headers": {}}
+        print("%-30s %15.0f" % (name, rate(lambda: api.method_handler(request, {}, None), opts.number)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: time to import api in a fresh interpreter, and for a
+server started as a subprocess the time until it accepts connections and
+the latency of its first and second requests, with the store connected
+lazily by the first request or warmed up at startup (--warmup). Redis
+runs need a Redis at the default address, they are skipped without it.
+
+    python benchmarks/bench_startup.py -r 5
+"""
+import os
+import sys
+import json
+import time
+import socket
+import statistics
+import subprocess
+from http.client import HTTPConnection
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import api
+
+IMPORT = "import time; t = time.perf_counter(); import api; print(time.perf_counter() - t)"
+MODES = (
+    ("memory", ["-s", "memory", "--interests", "cars,pets,travel"]),
+    ("redis lazy", ["-s", "redis"]),
+    ("redis warmup", ["-s", "redis", "--warmup", "4"]),
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def redis_available():
+    try:
+        socket.create_connection(("127.0.0.1", 6379), timeout=0.5).close()
+        return True
+    except OSError:
+        return False
+
+
+def import_time():
+    """Seconds to import api, and the whole interpreter run."""
+    started = time.perf_counter()
+    out = subprocess.check_output([sys.executable, "-c", IMPORT], cwd=ROOT)
+    return float(out), time.perf_counter() - started
+
+
+def request_body():
+    body = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+            "arguments": {"client_ids": [1, 2, 3]}}
+    body["token"] = api.user_digest(body["account"], body["login"])
+    return json.dumps(body)
+
+
+def first_requests(args):
+    """(seconds until the port accepts, first request seconds, second request seconds)"""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "api.py", "-p", str(port)] + args, cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("server exited with %s" % server.returncode)
+                time.sleep(0.005)
+        ready = time.perf_counter() - started
+        conn = HTTPConnection("localhost", port, timeout=10)
+        timings = []
+        for _ in range(2):
+            t = time.perf_counter()
+            conn.request("POST", "/method/", body=request_body(), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            timings.append(time.perf_counter() - t)
+        conn.close()
+        return ready, timings[0], timings[1]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    (opts, args) = op.parse_args()
+
+    runs = [import_time() for _ in range(opts.repeat)]
+    print("import api: %.1f ms (interpreter run %.1f ms), median of %d" % (
+        statistics.median(r[0] for r in runs) * 1000, statistics.median(r[1] for r in runs) * 1000, opts.repeat))
+
+    print("\n%-14s %12s %12s %12s" % ("store", "ready ms", "first ms", "second ms"))
+    redis_up = redis_available()
+    for name, mode_args in MODES:
+        if "redis" in mode_args and not redis_up:
+            print("%-14s %12s" % (name, "no redis"))
+            continue
+        results = [first_requests(mode_args) for _ in range(opts.repeat)]
+        print("%-14s %12.1f %12.2f %12.2f" % (name, *(statistics.median(r[i] for r in results) * 1000
+                                                        for i in range(3))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import math
+import time
+import random
+import threading
+from collections import OrderedDict
+
+FRESH = "fresh"
+EARLY = "early"
+STALE = "stale"
+# keys whose recompute time CachePolicy remembers
+DELTAS_SIZE = 10000
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache with bounded size, LRU eviction and
+    per-entry TTL. Expired entries are dropped lazily on access.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires, value = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        # an entry never lives longer than the cache ttl nor the one asked by the caller
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class CachePolicy(object):
+    """
+    Expiry of shared cache entries. A value is fresh for ttl seconds give or
+    take jitter (a share of ttl), so keys written together expire apart, and
+    is kept stale seconds more to be served while it is recomputed. A fresh
+    value is refreshed early with a probability growing towards its soft
+    expiry (XFetch: delta is the recompute time of the key, beta the
+    eagerness). Recompute times are kept per key in the process; for keys
+    computed elsewhere the latest one of any key stands in.
+    """
+
+    def __init__(self, ttl=3600, jitter=0.1, stale=60, beta=1.0, deltas_size=DELTAS_SIZE):
+        self.ttl = ttl
+        self.jitter = jitter
+        self.stale = stale
+        self.beta = beta
+        self.delta = 0.0
+        self.deltas = LRUCache(maxsize=deltas_size, ttl=ttl * (1 + jitter) + stale)
+
+    def record(self, key, delta):
+        """Recompute time of key, in seconds."""
+        self.delta = delta
+        self.deltas.set(key, delta)
+
+    def ttls(self):
+        """(soft, hard) TTLs in whole seconds for a value written now."""
+        soft = max(1, int(round(self.ttl * (1 + random.uniform(-self.jitter, self.jitter)))))
+        return soft, soft + self.stale
+
+    def soft_remaining(self, remaining):
+        return None if remaining is None else remaining - self.stale
+
+    def state(self, remaining, key=None):
+        """FRESH, EARLY or STALE for a value of key whose hard TTL has remaining seconds left (None for no TTL)."""
+        left = self.soft_remaining(remaining)
+        if left is None:
+            return FRESH
+        if left <= 0:
+            return STALE
+        delta = self.delta if key is None else self.deltas.get(key, self.delta)
+        if delta * self.beta * -math.log(1.0 - random.random()) >= left:
+            return EARLY
+        return FRESH
@@ -0,0 +1,61 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec(object):
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode(encoding='utf_8')
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        # clients_interests responses are keyed by int client ids
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj).encode(encoding='utf_8')
+
+
+CODECS = {
+    "orjson": (OrjsonCodec, orjson),
+    "ujson": (UjsonCodec, ujson),
+    "json": (JSONCodec, json),
+}
+
+
+def get_codec(name="auto"):
+    """Codec by name, or the fastest installed one for "auto"."""
+    if name == "auto":
+        for codec_cls, module in CODECS.values():
+            if module is not None:
+                return codec_cls()
+    codec_cls, module = CODECS[name]
+    if module is None:
+        raise ValueError("JSON codec %s is not installed" % name)
+    return codec_cls()
@@ -0,0 +1,135 @@
+import json
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+import redis
+
+LIST_KEY = 'list:interests'
+# bumped on every change of the list, readers reload the list only when it moves
+VERSION_KEY = 'list:interests:version'
+REFRESH_INTERVAL = 30
+# per-client values are a hex bitmask of catalog positions: "#5" is names[0] and names[2]
+MASK_PREFIX = b'#'
+
+Snapshot = namedtuple("Snapshot", ("version", "names", "index"))
+
+
+def pick(names, key):
+    """
+    Two interests for a client without stored ones, always the same for the
+    same key and list; all of them while the list is shorter than two.
+    """
+    if len(names) < 2:
+        return list(names)
+    h = int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], "big")
+    n = len(names)
+    first = h % n
+    second = h // n % (n - 1)
+    if second >= first:
+        second += 1
+    return [names[first], names[second]]
+
+
+class Catalog(object):
+    """
+    In-memory snapshot of list:interests. The list is append-only, so the
+    position of an interest never changes and per-client values can be
+    stored as bitmasks of positions. Readers check the version key at most
+    once per refresh_interval, piggybacked on their own round trip.
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.snapshot = Snapshot(None, (), {})
+        self.checked = None
+        self.reloads = 0
+        self._lock = threading.Lock()
+
+    def due(self):
+        return self.checked is None or time.monotonic() - self.checked >= self.refresh_interval
+
+    def load(self, conn):
+        pipe = conn.pipeline(transaction=False)
+        pipe.get(VERSION_KEY)
+        pipe.get(LIST_KEY)
+        return self.replace(*pipe.execute())
+
+    def replace(self, version, names):
+        names = tuple(names.decode('UTF-8').split(',')) if names else ()
+        self.snapshot = Snapshot(version, names, {name: i for i, name in enumerate(names)})
+        self.checked = time.monotonic()
+        self.reloads += 1
+        return self.snapshot
+
+    def sync(self, version, load):
+        """
+        Call load() to reload if the version read by the caller differs from
+        the snapshot (or there is no version key).
+        """
+        self.checked = time.monotonic()
+        snapshot = self.snapshot
+        if version is not None and version == snapshot.version:
+            return snapshot
+        with self._lock:
+            if self.snapshot is not snapshot:
+                return self.snapshot
+            return load()
+
+    def encode(self, names):
+        index = self.snapshot.index
+        mask = 0
+        for name in names:
+            mask |= 1 << index[name]
+        return MASK_PREFIX + b'%x' % mask
+
+    def decode(self, value, conn=None, key=None):
+        """Interests of the stored value of key: a bitmask, legacy JSON, or pick(key) for None."""
+        snapshot = self.snapshot
+        if value is None:
+            return pick(snapshot.names, key)
+        if not value.startswith(MASK_PREFIX):
+            return json.loads(value)
+        mask = int(value[len(MASK_PREFIX):], 16)
+        if mask.bit_length() > len(snapshot.names):
+            # written against a newer list than ours
+            if conn is not None:
+                snapshot = self.load(conn)
+            else:
+                # the list lives elsewhere (another shard, the memory store):
+                # known bits for now, the next call syncs the catalog
+                self.checked = None
+        names = snapshot.names
+        return [names[i] for i in range(min(mask.bit_length(), len(names))) if mask >> i & 1]
+
+    def stats(self):
+        return {"size": len(self.snapshot.names), "reloads": self.reloads}
+
+
+def add_names(conn, names):
+    """Append new interests to the list and bump its version."""
+    with conn.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(LIST_KEY)
+                current = pipe.get(LIST_KEY)
+                current = current.decode('UTF-8').split(',') if current else []
+                new = [name for name in names if name not in current]
+                if not new:
+                    return False
+                pipe.multi()
+                pipe.set(LIST_KEY, ','.join(current + new))
+                pipe.incr(VERSION_KEY)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+
+
+def set_client(conn, catalog, key, names, period=None):
+    """Store the interests of a client as a bitmask, adding unknown names to the list first."""
+    if any(name not in catalog.snapshot.index for name in names):
+        add_names(conn, names)
+        catalog.load(conn)
+    return conn.set(key, catalog.encode(names), ex=period)
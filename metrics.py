@@ -0,0 +1,116 @@
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# upper bounds of latency histograms, seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STAGE_SECONDS = "scoring_api_stage_seconds"
+# label value of routes and methods outside the known ones, so clients cannot add series
+OTHER = "other"
+REQUEST_SECONDS = "scoring_api_request_seconds"
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+
+def format_sample(name, labels, value):
+    if labels:
+        return "%s{%s} %s" % (name, format_labels(labels), value)
+    return "%s %s" % (name, value)
+
+
+class Histogram(object):
+    """
+    Observations take a lock of their own: an in-place addition is a read
+    and a write, and a thread switch between them would lose an update.
+    """
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield format_sample(name + "_bucket", labels + (("le", le),), cumulative)
+        yield format_sample(name + "_sum", labels, repr(total))
+        yield format_sample(name + "_count", labels, cumulative)
+
+
+class Registry(object):
+    """
+    Histograms keyed by name and a tuple of (label, value) pairs, plus
+    collectors: callables returning (name, type, [(sample name, labels, value)])
+    families, read on every scrape.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self.collectors = []
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, labels):
+        series = self._histograms.get(name)
+        histogram = series.get(labels) if series is not None else None
+        if histogram is None:
+            with self._lock:
+                series = self._histograms.setdefault(name, {})
+                histogram = series.setdefault(labels, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, name, labels, value):
+        if self.enabled:
+            self.histogram(name, labels).observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append("# TYPE %s histogram" % name)
+                for labels, histogram in sorted(series.items()):
+                    lines.extend(histogram.samples(name, labels))
+        for collector in self.collectors:
+            for name, kind, samples in collector():
+                lines.append("# TYPE %s %s" % (name, kind))
+                lines.extend(format_sample(sample, labels, value) for sample, labels, value in samples)
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def clear(self):
+        with self._lock:
+            for series in self._histograms.values():
+                for histogram in series.values():
+                    with histogram.lock:
+                        histogram.counts = [0] * len(histogram.counts)
+                        histogram.sum = 0.0
+
+
+REGISTRY = Registry()
+_stages = {}
+
+
+def observe_stage(stage, value):
+    histogram = _stages.get(stage)
+    if histogram is None:
+        histogram = _stages[stage] = REGISTRY.histogram(STAGE_SECONDS, (("stage", stage),))
+    if REGISTRY.enabled:
+        histogram.observe(value)
+
+
+def observe_request(route, method, code, value):
+    REGISTRY.observe(REQUEST_SECONDS, (("route", route), ("method", method), ("code", code)), value)
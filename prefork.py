@@ -0,0 +1,85 @@
+import os
+import time
+import socket
+import signal
+import logging
+
+BACKLOG = 1024
+CHECK_INTERVAL = 0.5
+GRACEFUL_TIMEOUT = 30
+
+
+def listen(server_address, backlog=BACKLOG):
+    """
+    Bind the listening socket once in the supervisor, workers inherit it
+    over fork(). The socket is non-blocking so a worker that loses the
+    accept() race goes back to its loop instead of hanging in accept().
+    """
+    sock = socket.create_server(server_address, backlog=backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Supervisor(object):
+    def __init__(self, target, workers, graceful_timeout=GRACEFUL_TIMEOUT):
+        self.target = target
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        # worker: SIGTERM is handled by the target, Ctrl+C goes to the supervisor only
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        code = 0
+        try:
+            self.target()
+        except Exception as e:
+            logging.exception("Worker %s failed: %s" % (os.getpid(), e))
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            self.children.discard(pid)
+            if not self.stopping:
+                logging.error("Worker %s exited with status %s, restarting" % (pid, status))
+                self.spawn()
+
+    def shutdown(self):
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(CHECK_INTERVAL / 5)
+        for pid in self.children:
+            logging.error("Worker %s did not stop in %ss, killing" % (pid, self.graceful_timeout))
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        logging.info("Started %s workers" % self.workers)
+        while not self.stopping:
+            self.reap()
+            time.sleep(CHECK_INTERVAL)
+        logging.info("Stopping %s workers" % len(self.children))
+        self.shutdown()
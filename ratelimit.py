@@ -0,0 +1,136 @@
+import time
+import threading
+from collections import Counter
+
+BUCKETS_SIZE = 100000
+CONCURRENCY = "concurrency"
+CLIENT_IDS = "client_ids"
+
+
+class TokenBuckets(object):
+    """
+    Token buckets per key in the process: a bucket holds up to burst tokens
+    and gains rate tokens per second. Buckets are created full on first use;
+    past maxsize the least recently used ones are forgotten (they come back
+    full, which only errs on the side of admitting).
+    """
+
+    def __init__(self, maxsize=BUCKETS_SIZE):
+        self.maxsize = maxsize
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        return self.take_many([(key, rate, burst, cost)]) is None
+
+    def take_many(self, buckets):
+        """
+        Take cost tokens from every (key, rate, burst, cost) bucket, or from
+        none of them: the position of the first bucket short of tokens, None
+        when all were charged.
+        """
+        now = time.monotonic()
+        with self._lock:
+            left = []
+            for i, (key, rate, burst, cost) in enumerate(buckets):
+                bucket = self._buckets.get(key)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+                if tokens < cost:
+                    return i
+                left.append((key, tokens - cost))
+            for key, tokens in left:
+                self._buckets.pop(key, None)
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                del self._buckets[next(iter(self._buckets))]
+        return None
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Admission(object):
+    """
+    Admission control in front of the router, checked on the decoded body
+    before validation: a cap on requests in progress, token buckets per
+    login, per account and per (method, login) for methods registered with
+    a rate_limit, and a cap on client_ids per request. A batch costs one
+    token per item; with authenticate set only the items it accepts are
+    charged, so forged tokens cannot spend the quota of a partner. Tokens
+    are taken from all the buckets of a request or from none. With shared
+    set to a store backend the buckets live in the store and are common to
+    all processes, the local buckets stand in while it raises one of
+    shared_errors.
+    """
+
+    def __init__(self, login_rate=None, account_rate=None, burst=None, max_client_ids=None, max_concurrency=None,
+                 method_rates=None, shared=None, shared_errors=(), authenticate=None):
+        self.login_rate = login_rate
+        self.account_rate = account_rate
+        self.burst = burst
+        self.max_client_ids = max_client_ids
+        self.method_rates = method_rates or {}
+        self.shared = shared
+        self.shared_errors = shared_errors
+        self.authenticate = authenticate
+        self.local = TokenBuckets()
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.rejected = Counter()
+        # without any limit requests skip admission altogether
+        self.active = bool(login_rate or account_rate or max_client_ids or max_concurrency or self.method_rates)
+
+    def take(self, buckets, deadline=None):
+        """TokenBuckets.take_many in the shared store, or in the process while the store fails."""
+        if self.shared is not None:
+            try:
+                return self.shared.take_tokens(buckets, deadline=deadline)
+            except self.shared_errors:
+                pass
+        return self.local.take_many(buckets)
+
+    def costs(self, items):
+        """Token costs per (limit, key, rate) of the request items, or the reason to reject them."""
+        costs = Counter()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            arguments = item.get("arguments")
+            if self.max_client_ids and isinstance(arguments, dict):
+                client_ids = arguments.get("client_ids")
+                if isinstance(client_ids, list) and len(client_ids) > self.max_client_ids:
+                    return CLIENT_IDS
+            if self.authenticate is not None and not self.authenticate(item):
+                continue
+            login, account, method = item.get("login"), item.get("account"), item.get("method")
+            if self.login_rate and isinstance(login, str):
+                costs["login", "login:" + login, self.login_rate] += 1
+            if self.account_rate and isinstance(account, str):
+                costs["account", "account:" + account, self.account_rate] += 1
+            if isinstance(method, str) and isinstance(login, str) and self.method_rates.get(method):
+                costs["method", "method:%s:%s" % (method, login), self.method_rates[method]] += 1
+        return costs
+
+    def admit(self, body, deadline=None):
+        """
+        None if the request may go on (then release() when it is done), else
+        the reason of the rejection. deadline bounds the shared store call.
+        """
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            self.rejected[CONCURRENCY] += 1
+            return CONCURRENCY
+        costs = self.costs(body if isinstance(body, list) else [body])
+        if isinstance(costs, str):
+            reason = costs
+        else:
+            limits = list(costs)
+            short = self.take([(key, rate, max(self.burst or rate, cost), cost)
+                               for (limit, key, rate), cost in costs.items()], deadline) if limits else None
+            reason = limits[short][0] if short is not None else None
+        if reason is not None:
+            self.release()
+            self.rejected[reason] += 1
+        return reason
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
@@ -1,23 +1,88 @@
+import time
 import hashlib
-import json
+import threading
+import cache
+import interests
+import singleflight
 import store
 
-redis_client = store.RedisClient()
+SCORE_TTL = 60 * 60
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TTL = 5 * 60
 
+# store of the process, calls may pass their own; nothing is created or
+# connected at import, see init_store and get_backend
+default_backend = None
+_backend_lock = threading.Lock()
+# first tier in front of the store, entries never outlive the Redis copy
+local_cache = cache.LRUCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+interests_catalog = interests.Catalog()
+# one store read, computation and write per score key at a time
+score_flights = singleflight.Group()
+# background refreshes of stale or early-expiring scores, one per key
+refresh_flights = singleflight.Group()
+policy = cache.CachePolicy(ttl=SCORE_TTL)
 
-def get_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+
+def init_policy(**options):
+    """Score cache policy: ttl, jitter, stale and beta, see cache.CachePolicy."""
+    global policy
+    policy = cache.CachePolicy(**options)
+
+
+def get_backend():
+    """The default store, a Redis one with default options unless init_store set another."""
+    global default_backend
+    if default_backend is None:
+        with _backend_lock:
+            if default_backend is None:
+                default_backend = store.RedisBackend()
+    return default_backend
+
+
+def warm_up(connections=1):
+    """Connect the default store and load the interests catalog ahead of the first request."""
+    backend = get_backend()
+    backend.warm_up(connections)
+    backend.sync_catalog(interests_catalog)
+
+
+def init_store(backend):
+    """Make backend the default store, e.g. a fresh Redis pool in a newly forked worker."""
+    global default_backend
+    default_backend = backend
+    return default_backend
+
+
+def stats():
+    return {"local_cache": local_cache.stats(), "interests": interests_catalog.stats(),
+            "single_flight": score_flights.stats(), "refresh": refresh_flights.stats(),
+            "store": default_backend.stats() if default_backend is not None else {}}
+
+
+def cached(method, *args, default=None, deadline=None):
+    """
+    Score cache call to a backend method, skipped (default) while the store
+    is unavailable or the deadline is spent: scores degrade to computing.
+    """
+    try:
+        return method(*args, deadline=deadline)
+    except store.StoreUnavailable:
+        return default
+
+
+def score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         str(phone) or "",
         str(birthday) if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(redis_client.conn, key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
+
+
+def compute_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -26,11 +91,88 @@ def get_score(phone, email, birthday=None, gender=None, first_name=None, last_na
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(redis_client.conn, key, score, 60 * 60)
     return score
 
 
-def get_interests(cid):
-    r = store.get(redis_client.conn, "i:%s" % cid)
-    return json.loads(r) if r else []
+def get_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None, backend=None,
+              deadline=None):
+    backend = backend or get_backend()
+    key = score_key(phone, birthday, first_name, last_name)
+    # try get from local cache, then from the store,
+    # fallback to heavy calculation in case of cache miss
+    score = local_cache.get(key)
+    if score is not None:
+        return score
+    # concurrent misses of the same key wait for the first one, as long as their deadline allows
+    return score_flights.do(key, load_score, backend, deadline, key, phone, email, birthday, gender, first_name,
+                            last_name, timeout=deadline.remaining() if deadline is not None else None)
+
+
+def load_score(backend, deadline, key, *args):
+    score, remaining = cached(backend.get_ttl, key, default=(None, None), deadline=deadline)
+    if score:
+        return revalidate(backend, key, score, remaining, args)
+    return refresh_score(backend, key, *args, deadline=deadline)
+
+
+def revalidate(backend, key, score, remaining, args):
+    """Serve a stored score, refreshing it in the background when stale or due for early refresh."""
+    if policy.state(remaining, key) == cache.FRESH:
+        local_cache.set(key, score, policy.soft_remaining(remaining))
+    else:
+        refresh_flights.spawn(key, refresh_score, backend, key, *args)
+    return score
+
+
+def refresh_score(backend, key, phone, email, birthday=None, gender=None, first_name=None, last_name=None,
+                  deadline=None):
+    started = time.perf_counter()
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
+    soft, hard = policy.ttls()
+    cached(backend.set, key, score, hard, deadline=deadline)
+    policy.record(key, time.perf_counter() - started)
+    local_cache.set(key, score, soft)
+    return score
+
+
+def get_scores(items, backend=None, deadline=None):
+    """
+    get_score for many (phone, email, birthday, gender, first_name, last_name)
+    tuples with one bulk store read and one bulk write for the misses.
+    """
+    backend = backend or get_backend()
+    keys = [score_key(phone, birthday, first_name, last_name)
+            for phone, email, birthday, gender, first_name, last_name in items]
+    scores = [local_cache.get(key) for key in keys]
+    missing = [i for i, score in enumerate(scores) if score is None]
+    stored = cached(backend.get_many_ttl, [keys[i] for i in missing], default=[(None, None)] * len(missing),
+                    deadline=deadline)
+    computed, ttls = {}, {}
+    for i, (score, remaining) in zip(missing, stored):
+        key = keys[i]
+        if score:
+            score = revalidate(backend, key, score, remaining, items[i])
+        elif key in computed:
+            score = computed[key]
+        else:
+            started = time.perf_counter()
+            score = computed[key] = compute_score(*items[i])
+            policy.record(key, time.perf_counter() - started)
+            ttls[key] = policy.ttls()
+        scores[i] = score
+    cached(backend.set_many, computed, policy.ttl, {key: hard for key, (soft, hard) in ttls.items()},
+           deadline=deadline)
+    for key, score in computed.items():
+        local_cache.set(key, score, ttls[key][0])
+    return scores
+
+
+def get_interests(cid, backend=None, deadline=None):
+    return get_interests_many([cid], backend, deadline)[cid]
+
+
+def get_interests_many(cids, backend=None, deadline=None):
+    backend = backend or get_backend()
+    # interests have no fallback, StoreUnavailable (DeadlineExceeded too) fails the request right away
+    r = backend.interests(["i:%s" % cid for cid in cids], interests_catalog, deadline=deadline)
+    return dict(zip(cids, r))
@@ -0,0 +1,72 @@
+import logging
+import threading
+
+
+class Call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs
+    func, the others block until it finishes and get its result or its
+    exception. Nothing is remembered once the call is over. A caller that
+    cannot wait longer than timeout seconds runs func on its own after that.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, func, *args, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                self.shared += 1
+        if not leader:
+            if not call.done.wait(timeout):
+                return func(*args)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        return self._run(key, call, func, args)
+
+    def spawn(self, key, func, *args):
+        """Run func in a background thread unless a call with key is in flight. True if started."""
+        with self._lock:
+            if key in self._calls:
+                self.shared += 1
+                return False
+            call = self._calls[key] = Call()
+        threading.Thread(target=self._background, args=(key, call, func, args), daemon=True).start()
+        return True
+
+    def _background(self, key, call, func, args):
+        try:
+            self._run(key, call, func, args)
+        except Exception as e:
+            logging.error("Background call %s failed: %s" % (key, e))
+
+    def _run(self, key, call, func, args):
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "shared": self.shared}
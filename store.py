@@ -1,16 +1,306 @@
 import time
-import random
+import bisect
+import hashlib
+import functools
 import json
+import logging
+import threading
 import redis
 import os
+from queue import LifoQueue
+
+import interests
+import metrics
+import ratelimit
 
 REDIS_AUTH = {
     'PASSWORD': os.environ.get('REDIS_PASSWORD'),
     'HOST': '127.0.0.1',
     'PORT': 6379,
     'HEALTH': 10,
+    'CONNECT_TIMEOUT': 1,
+    'FAILURES': 3,
+    'POOL_SIZE': 50,
+    'POOL_TIMEOUT': 5,
+    'POOL_IDLE': 300,
     'DB': 0
 }
+# max keys per MGET command inside one pipeline
+BATCH_SIZE = 500
+# points per shard on the consistent hash ring
+REPLICAS = 100
+# token buckets in hashes {t: tokens, u: updated}, atomic on the Redis side
+# KEYS - buckets, ARGV - now, then rate, burst and cost of every bucket;
+# returns 0 when the tokens were taken from every bucket, else the 1-based
+# position of the first bucket short of tokens, and then nothing is written
+TOKEN_BUCKET = """
+local now = tonumber(ARGV[1])
+local left = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst, cost = tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3]), tonumber(ARGV[i * 3 + 1])
+    local bucket = redis.call('HMGET', key, 't', 'u')
+    local tokens = tonumber(bucket[1])
+    if tokens == nil then
+        tokens = burst
+    else
+        tokens = math.min(burst, tokens + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    if tokens < cost then
+        return i
+    end
+    left[i] = tokens - cost
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3])
+    redis.call('HSET', key, 't', tostring(left[i]), 'u', ARGV[1])
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return 0
+"""
+RATE_LIMIT_PREFIX = "rl:"
+_token_bucket = []
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+# socket timeouts are never set below this, a budget this small is spent anyway
+MIN_TIMEOUT = 0.001
+# upper bounds of the pool checkout wait histogram, seconds
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class StoreUnavailable(Exception):
+    pass
+
+
+class DeadlineExceeded(StoreUnavailable):
+    """The request ran out of time for store calls, Redis itself may be fine."""
+    pass
+
+
+class Deadline(object):
+    """Point in time by which a request has to be answered, on the monotonic clock."""
+    __slots__ = ("expires",)
+
+    def __init__(self, timeout):
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.expires <= time.monotonic()
+
+    def __repr__(self):
+        return "Deadline(%.3fs left)" % self.remaining()
+
+    @classmethod
+    def earliest(cls, deadline, timeout):
+        """deadline, or a new one in timeout seconds if that comes first; either may be None."""
+        if timeout is None:
+            return deadline
+        if deadline is None or deadline.remaining() > timeout:
+            return cls(timeout)
+        return deadline
+
+
+# deadline of the store call running in this thread, read when a connection is checked out
+_budget = threading.local()
+
+
+class PoolExhausted(redis.exceptions.ConnectionError):
+    pass
+
+
+def budget_timeout(sock):
+    """Limit the reads of sock to what is left of the deadline of the store call in this thread."""
+    deadline = getattr(_budget, "deadline", None)
+    if deadline is not None and sock is not None:
+        sock.settimeout(max(deadline.remaining(), MIN_TIMEOUT))
+
+
+class BudgetConnection(redis.Connection):
+    """
+    Connection whose handshake after connecting also keeps within the
+    deadline, and which reports opened and closed sockets to its pool.
+    """
+    pool = None
+
+    def _connect(self):
+        sock = super()._connect()
+        if self.pool is not None:
+            self.pool.socket_opened()
+        budget_timeout(sock)
+        return sock
+
+    def disconnect(self, *args, **kwargs):
+        opened = self._sock is not None
+        super().disconnect(*args, **kwargs)
+        if opened and self.pool is not None:
+            self.pool.socket_closed()
+
+
+class BudgetQueue(LifoQueue):
+    """Pool queue whose blocking get waits no longer than the deadline of the store call in this thread."""
+
+    def get(self, block=True, timeout=None):
+        deadline = getattr(_budget, "deadline", None)
+        if block and deadline is not None:
+            remaining = max(deadline.remaining(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return super().get(block, timeout)
+
+
+class InstrumentedPool(redis.BlockingConnectionPool):
+    """
+    Bounded pool: at most max_connections sockets, checkout waits up to
+    timeout seconds or what is left of the deadline, connections idle for longer than idle_timeout are
+    closed. Keeps counters for stats(): created and destroyed count
+    sockets as they are opened and closed, in_use the connections checked
+    out.
+    """
+
+    def __init__(self, idle_timeout=REDIS_AUTH['POOL_IDLE'], **kwargs):
+        self.idle_timeout = idle_timeout
+        super().__init__(connection_class=BudgetConnection, queue_class=BudgetQueue, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        self._checked_out = set()
+        self._reaped_at = time.monotonic()
+        self.created = 0
+        self.destroyed = 0
+        self.in_use = 0
+        self.timeouts = 0
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+
+    def make_connection(self):
+        connection = super().make_connection()
+        connection.pool = self
+        return connection
+
+    def socket_opened(self):
+        with self._stats_lock:
+            self.created += 1
+
+    def socket_closed(self):
+        with self._stats_lock:
+            self.destroyed += 1
+
+    def get_connection(self, command_name=None, *keys, **options):
+        started = time.monotonic()
+        try:
+            connection = super().get_connection()
+        except redis.exceptions.ConnectionError as e:
+            if str(e) != "No connection available.":
+                raise
+            with self._stats_lock:
+                self.timeouts += 1
+            deadline = getattr(_budget, "deadline", None)
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("Deadline exceeded waiting for a Redis connection")
+            raise PoolExhausted("No connection available in %ss" % self.timeout)
+        waited = time.monotonic() - started
+        bucket = 0
+        while bucket < len(WAIT_BUCKETS) and waited > WAIT_BUCKETS[bucket]:
+            bucket += 1
+        with self._stats_lock:
+            self._checked_out.add(connection)
+            self.in_use += 1
+            self.wait_counts[bucket] += 1
+            self.wait_sum += waited
+        budget_timeout(connection._sock)
+        return connection
+
+    def release(self, connection):
+        if getattr(_budget, "deadline", None) is not None and connection._sock is not None:
+            connection._sock.settimeout(connection.socket_timeout)
+        now = time.monotonic()
+        with self._stats_lock:
+            # redis-py also releases connections that failed to connect during checkout
+            if connection in self._checked_out:
+                self._checked_out.discard(connection)
+                self.in_use -= 1
+            self._last_used[connection] = now
+        super().release(connection)
+        if now - self._reaped_at > self.idle_timeout / 2:
+            self.reap(now)
+
+    def reap(self, now=None):
+        """Close connections idle for longer than idle_timeout, they reconnect on next checkout."""
+        now = now or time.monotonic()
+        self._reaped_at = now
+        reaped = 0
+        # holding the queue mutex keeps the connections from being checked out meanwhile
+        with self.pool.mutex:
+            for connection in self.pool.queue:
+                if connection is None or getattr(connection, "_sock", None) is None:
+                    continue
+                if now - self._last_used.get(connection, now) > self.idle_timeout:
+                    connection.disconnect()
+                    reaped += 1
+        return reaped
+
+    def stats(self):
+        with self.pool.mutex:
+            idle = sum(1 for c in self.pool.queue if c is not None and getattr(c, "_sock", None) is not None)
+        with self._stats_lock:
+            return {
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "idle": idle,
+                "created": self.created,
+                "destroyed": self.destroyed,
+                "timeouts": self.timeouts,
+                "wait_buckets": list(zip(WAIT_BUCKETS + (float("inf"),), self.wait_counts)),
+                "wait_sum": self.wait_sum,
+            }
+
+
+class CircuitBreaker(object):
+    """
+    closed: calls go through, consecutive failures are counted;
+    open: calls are refused right away after failure_threshold failures;
+    half-open: the background probe is checking the store, calls are still refused.
+    """
+
+    def __init__(self, failure_threshold=REDIS_AUTH['FAILURES'], reset_timeout=REDIS_AUTH['HEALTH']):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.state == CLOSED
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+
+    def failure(self):
+        """Count a failure, True if it has just opened the circuit."""
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                opened = self.state == CLOSED
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+    def half_open(self):
+        """Move an open circuit to half-open once reset_timeout has passed."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+            return False
 
 
 class RedisClient:
@@ -20,65 +310,443 @@ class RedisClient:
                  db=REDIS_AUTH['DB'],
                  password=REDIS_AUTH['PASSWORD'],
                  health_check_interval=REDIS_AUTH['HEALTH'],
-                 socket_timeout=REDIS_AUTH['HEALTH'] * 3):
+                 socket_timeout=REDIS_AUTH['HEALTH'] * 3,
+                 socket_connect_timeout=REDIS_AUTH['CONNECT_TIMEOUT'],
+                 failure_threshold=REDIS_AUTH['FAILURES'],
+                 max_connections=REDIS_AUTH['POOL_SIZE'],
+                 pool_timeout=REDIS_AUTH['POOL_TIMEOUT'],
+                 idle_timeout=REDIS_AUTH['POOL_IDLE']):
         self._host = host
         self._port = port
         self._db = db
         self._password = password
         self._health = health_check_interval
         self._timeout = socket_timeout
-        self.pool = redis.ConnectionPool(
+        self.pool = InstrumentedPool(
             host=self._host,
             port=self._port,
             db=self._db,
             password=self._password,
             health_check_interval=self._health,
             socket_timeout=self._timeout,
+            socket_connect_timeout=socket_connect_timeout,
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            idle_timeout=idle_timeout,
         )
+        self.breaker = CircuitBreaker(failure_threshold, self._health)
+        self._probe = None
+        self.get_connection()
 
     @property
     def conn(self):
-        for reconnect in range(4):
-            try:
-
-                if not hasattr(self, '_conn'):
-                    self.get_connection()
-                else:
-                    if self.pool.get_connection("_"):
-                        return self._conn
-                    time.sleep(self._health)
-                    self.get_connection()
-                    if reconnect == 3:
-                        return
-            except redis.exceptions.ConnectionError:
-                continue
+        """Redis client, None while the circuit is open."""
+        if self.breaker.allow():
+            return self._conn
 
     def get_connection(self):
         self._conn = redis.StrictRedis(connection_pool=self.pool)
 
+    def call(self, func, *args, deadline=None, **kwargs):
+        """
+        func(conn, *args, **kwargs) guarded by the circuit breaker. Raises
+        StoreUnavailable without touching Redis while the circuit is open.
+        With a deadline the socket reads wait no longer than the time left,
+        and DeadlineExceeded is raised once it is spent.
+        """
+        conn = self.conn
+        if conn is None:
+            raise StoreUnavailable("Redis is unavailable")
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded("Deadline exceeded before the Redis call")
+        started = time.perf_counter()
+        _budget.deadline = deadline
+        try:
+            result = func(conn, *args, **kwargs)
+        except PoolExhausted as e:
+            # too busy rather than down, the circuit stays as it is
+            raise StoreUnavailable(str(e))
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            if deadline is not None and deadline.expired():
+                # our budget ran out, which says nothing about Redis
+                raise DeadlineExceeded("Deadline exceeded in the Redis call: %s" % e)
+            self.failed(e)
+            raise StoreUnavailable("Redis is unavailable: %s" % e)
+        finally:
+            _budget.deadline = None
+        metrics.observe_stage("redis", time.perf_counter() - started)
+        if self.breaker.failures:
+            self.breaker.success()
+        return result
+
+    def stats(self):
+        return {"breaker": self.breaker.state, "pool": self.pool.stats()}
+
+    def failed(self, e):
+        if self.breaker.failure():
+            logging.error("Redis circuit opened: %s" % e)
+            self._probe = threading.Thread(target=self.probe, daemon=True)
+            self._probe.start()
+
+    def probe(self):
+        """Health checks off the request path until Redis answers again."""
+        while self.breaker.state != CLOSED:
+            time.sleep(self.breaker.reset_timeout)
+            if not self.breaker.half_open():
+                continue
+            try:
+                self._conn.ping()
+            except redis.exceptions.RedisError as e:
+                self.breaker.failure()
+                logging.error("Redis health check failed: %s" % e)
+            else:
+                self.breaker.success()
+                logging.info("Redis circuit closed")
+
 
 def conn_exist(redis_client):
     return redis_client.conn
 
 
+def encode_score(score, period):
+    """
+    score|expires_at with the wall clock time the key expires at, so that
+    one GET tells the remaining TTL too; hosts sharing the cache need
+    synced clocks.
+    """
+    if not period:
+        return score
+    return "%s|%.3f" % (score, time.time() + period)
+
+
+def decode_score(value):
+    """(score, remaining TTL in seconds) of a stored value; None for values written without a TTL."""
+    score, _, expires = value.decode('UTF-8').partition("|")
+    return float(score), (float(expires) - time.time() if expires else None)
+
+
 def cache_set(conn, key, score, period):
-    i = 0
     if conn:
-        rsetter = conn.set(name=key, value=score, ex=period)
-    return rsetter
+        return conn.set(name=key, value=encode_score(score, period), ex=period)
 
 
 def cache_get(conn, key=None):
+    """Single GET, a miss is None without an EXISTS round trip."""
+    if conn:
+        value = conn.get(key)
+        if value is not None:
+            return decode_score(value)[0]
+
+
+def cache_set_many(conn, mapping, period, periods=None):
+    """SET of every key in one round trip, periods overrides period per key."""
+    if conn and mapping:
+        pipe = conn.pipeline(transaction=False)
+        for key, score in mapping.items():
+            ex = periods.get(key, period) if periods else period
+            pipe.set(name=key, value=encode_score(score, ex), ex=ex)
+        return all(pipe.execute())
+
+
+def cache_get_many_ttl(conn, keys, batch_size=BATCH_SIZE):
+    """(value, remaining TTL in seconds) for keys in one round trip of MGETs, (None, None) for misses."""
+    if not conn or not keys:
+        return [(None, None)] * len(keys)
+    pipe = conn.pipeline(transaction=False)
+    for i in range(0, len(keys), batch_size):
+        pipe.mget(keys[i:i + batch_size])
+    return [decode_score(value) if value is not None else (None, None)
+            for chunk in pipe.execute() for value in chunk]
+
+
+def cache_get_ttl(conn, key):
+    """Cached value and its remaining TTL in seconds with a single GET."""
     if conn:
-        if conn.exists(key):
-            rgetter = float(conn.get(key).decode('UTF-8'))
-            return rgetter
+        value = conn.get(key)
+        if value is not None:
+            return decode_score(value)
+    return None, None
 
 
 def get(conn, key):
     if conn:
         l = conn.get('list:interests').decode('UTF-8').split(',')
-        res = '["' + '","'.join(random.sample(l, 2)) + '"]'
+        res = '["' + '","'.join(interests.pick(l, key)) + '"]'
         return res
     else:
         return False
+
+
+def get_many(conn, keys, catalog, batch_size=BATCH_SIZE, sync=True):
+    """
+    Interests for many keys in one round trip: MGET of the per-client keys,
+    split into batch_size chunks, decoded against the in-memory catalog.
+    The catalog version is read in the same pipeline when it is due for a
+    check, unless sync is off (the catalog lives on another instance).
+    Keys without a stored value get interests.pick of the catalog.
+    """
+    if not conn:
+        return False
+    pipe = conn.pipeline(transaction=False)
+    check = sync and catalog.due()
+    if check:
+        pipe.get(interests.VERSION_KEY)
+    for i in range(0, len(keys), batch_size):
+        pipe.mget(keys[i:i + batch_size])
+    replies = pipe.execute()
+    if check:
+        catalog.sync(replies.pop(0), functools.partial(catalog.load, conn))
+    return decode_interests(catalog, keys, [value for chunk in replies for value in chunk], conn if sync else None)
+
+
+def decode_interests(catalog, keys, values, conn=None):
+    """catalog.decode of the stored values; StoreUnavailable if a client needs a pick from an empty catalog."""
+    if not catalog.snapshot.names and None in values:
+        raise StoreUnavailable("Interests catalog %s is empty" % interests.LIST_KEY)
+    return [catalog.decode(value, conn, key) for key, value in zip(keys, values)]
+
+
+def sync_catalog(conn, catalog):
+    """Check the catalog version and reload the list if it moved."""
+    if conn:
+        return catalog.sync(conn.get(interests.VERSION_KEY), functools.partial(catalog.load, conn))
+
+
+def take_tokens(conn, buckets):
+    """
+    ratelimit.TokenBuckets.take_many shared through Redis, see TOKEN_BUCKET.
+    Time is the wall clock of the caller, so hosts sharing buckets need
+    synced clocks.
+    """
+    if not _token_bucket:
+        # EVALSHA with a fallback to EVAL, the script is sent once per server
+        _token_bucket.append(conn.register_script(TOKEN_BUCKET))
+    args = [repr(time.time())]
+    for key, rate, burst, cost in buckets:
+        args.extend((rate, burst, cost))
+    short = _token_bucket[0](keys=[RATE_LIMIT_PREFIX + bucket[0] for bucket in buckets], args=args, client=conn)
+    return short - 1 if short else None
+
+
+def warm_up(conn, connections):
+    """Check out connections of the pool at once, which connects them, and PING each."""
+    pool = conn.connection_pool
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(pool.get_connection())
+        for connection in opened:
+            connection.send_command("PING")
+            connection.read_response()
+    finally:
+        for connection in opened:
+            pool.release(connection)
+    return len(opened)
+
+
+class RedisBackend(RedisClient):
+    """
+    Store backend on one Redis instance. Backends answer the calls of the
+    scoring module: get, get_ttl, get_many_ttl, set, set_many, interests,
+    sync_catalog, warm_up, take_tokens and stats, and raise StoreUnavailable
+    when they cannot. The cache and interests calls take the request
+    deadline, DeadlineExceeded is raised once it is spent.
+    """
+
+    @property
+    def name(self):
+        return "%s:%s/%s" % (self._host, self._port, self._db)
+
+    def get(self, key, deadline=None):
+        return self.call(cache_get, key, deadline=deadline)
+
+    def get_ttl(self, key, deadline=None):
+        return self.call(cache_get_ttl, key, deadline=deadline)
+
+    def get_many_ttl(self, keys, deadline=None):
+        return self.call(cache_get_many_ttl, keys, deadline=deadline)
+
+    def set(self, key, value, ttl, deadline=None):
+        return self.call(cache_set, key, value, ttl, deadline=deadline)
+
+    def set_many(self, mapping, ttl, ttls=None, deadline=None):
+        return self.call(cache_set_many, mapping, ttl, ttls, deadline=deadline)
+
+    def interests(self, keys, catalog, sync=True, deadline=None):
+        return self.call(get_many, keys, catalog, sync=sync, deadline=deadline)
+
+    def sync_catalog(self, catalog):
+        return self.call(sync_catalog, catalog)
+
+    def warm_up(self, connections=1):
+        return self.call(warm_up, min(connections, self.pool.max_connections))
+
+    def take_tokens(self, buckets, deadline=None):
+        return self.call(take_tokens, buckets, deadline=deadline)
+
+
+class MemoryBackend(object):
+    """
+    Store backend in a dict of the process, for tests and single-node runs.
+    Values are kept as Redis returns them. Expired keys are dropped when
+    read, and when maxsize is reached the oldest writes go first. Calls
+    never block, so deadlines are accepted and ignored.
+    """
+
+    def __init__(self, name="memory", maxsize=1000000, names=None):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+        self._buckets = ratelimit.TokenBuckets()
+        if names:
+            self.load_interests(names)
+
+    def load_interests(self, names):
+        """Seed list:interests, the memory store has no other writer of the catalog."""
+        self.set(interests.LIST_KEY, ",".join(names), None)
+        self.set(interests.VERSION_KEY, int(self._value(interests.VERSION_KEY) or 0) + 1, None)
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return item
+
+    def _value(self, key):
+        item = self._get(key)
+        return item[0] if item is not None else None
+
+    def get(self, key, deadline=None):
+        value = self._value(key)
+        return float(value.decode('UTF-8')) if value is not None else None
+
+    def get_ttl(self, key, deadline=None):
+        item = self._get(key)
+        if item is None:
+            return None, None
+        return float(item[0].decode('UTF-8')), (item[1] - time.monotonic() if item[1] is not None else None)
+
+    def get_many_ttl(self, keys, deadline=None):
+        return [self.get_ttl(key) for key in keys]
+
+    def set(self, key, value, ttl, deadline=None):
+        if not isinstance(value, bytes):
+            value = str(value).encode('UTF-8')
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+            while len(self._data) > self.maxsize:
+                del self._data[next(iter(self._data))]
+        return True
+
+    def set_many(self, mapping, ttl, ttls=None, deadline=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttls.get(key, ttl) if ttls else ttl)
+        return True
+
+    def interests(self, keys, catalog, sync=True, deadline=None):
+        if sync and catalog.due():
+            self.sync_catalog(catalog)
+        return decode_interests(catalog, keys, [self._value(key) for key in keys])
+
+    def sync_catalog(self, catalog):
+        version = self._value(interests.VERSION_KEY)
+        return catalog.sync(version, lambda: catalog.replace(version, self._value(interests.LIST_KEY)))
+
+    def warm_up(self, connections=1):
+        return 0
+
+    def take_tokens(self, buckets, deadline=None):
+        return self._buckets.take_many(buckets)
+
+    def stats(self):
+        return {"keys": len(self._data)}
+
+
+def hash_point(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], "big")
+
+
+class ShardedBackend(object):
+    """
+    Spreads keys over several backends with a consistent hash ring of
+    replicas points per shard, keyed by shard name, so adding a shard moves
+    only about 1/n of the keys. Multi-key calls are split per shard; cache
+    reads and writes of an unavailable shard degrade to misses and skipped
+    writes, interests fail. The interests catalog lives on the shard owning
+    list:interests, the rate limit buckets on the shard owning rl:.
+    """
+
+    def __init__(self, shards, replicas=REPLICAS):
+        self.shards = list(shards)
+        self.name = "sharded"
+        ring = sorted((hash_point("%s#%s" % (shard.name, i)), n)
+                      for n, shard in enumerate(self.shards) for i in range(replicas))
+        self._points = [point for point, n in ring]
+        self._owners = [n for point, n in ring]
+
+    def shard(self, key):
+        i = bisect.bisect(self._points, hash_point(key)) % len(self._points)
+        return self.shards[self._owners[i]]
+
+    def group(self, keys):
+        """{shard: [positions of its keys]}"""
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.shard(key), []).append(i)
+        return groups
+
+    def get(self, key, deadline=None):
+        return self.shard(key).get(key, deadline)
+
+    def get_ttl(self, key, deadline=None):
+        return self.shard(key).get_ttl(key, deadline)
+
+    def get_many_ttl(self, keys, deadline=None):
+        result = [(None, None)] * len(keys)
+        for shard, positions in self.group(keys).items():
+            try:
+                values = shard.get_many_ttl([keys[i] for i in positions], deadline)
+            except StoreUnavailable:
+                continue
+            for i, value in zip(positions, values):
+                result[i] = value
+        return result
+
+    def set(self, key, value, ttl, deadline=None):
+        return self.shard(key).set(key, value, ttl, deadline)
+
+    def set_many(self, mapping, ttl, ttls=None, deadline=None):
+        keys = list(mapping)
+        done = True
+        for shard, positions in self.group(keys).items():
+            try:
+                shard.set_many({keys[i]: mapping[keys[i]] for i in positions}, ttl, ttls, deadline)
+            except StoreUnavailable:
+                done = False
+        return done
+
+    def interests(self, keys, catalog, sync=True, deadline=None):
+        if sync and catalog.due():
+            self.sync_catalog(catalog)
+        result = [None] * len(keys)
+        for shard, positions in self.group(keys).items():
+            values = shard.interests([keys[i] for i in positions], catalog, sync=False, deadline=deadline)
+            for i, value in zip(positions, values):
+                result[i] = value
+        return result
+
+    def sync_catalog(self, catalog):
+        return self.shard(interests.LIST_KEY).sync_catalog(catalog)
+
+    def warm_up(self, connections=1):
+        return sum(shard.warm_up(connections) for shard in self.shards)
+
+    def take_tokens(self, buckets, deadline=None):
+        # the buckets of a request are charged by one script, so they all live on one shard
+        return self.shard(RATE_LIMIT_PREFIX).take_tokens(buckets, deadline)
+
+    def stats(self):
+        return {"shards": {shard.name: shard.stats() for shard in self.shards}}
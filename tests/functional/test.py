@@ -1,9 +1,20 @@
+import json
+import time
+import socket
 import hashlib
 import datetime
 import functools
+import threading
 import unittest
+from http.client import HTTPConnection
+from optparse import Values
 
 import api
+import aioserver
+import ratelimit
+import interests
+import scoring
+import store
 
 
 def cases(cases):
@@ -141,6 +152,347 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_memory_store(self):
+        backend = store.MemoryBackend()
+        backend.set(interests.LIST_KEY, "books,tv", None)
+        backend.set("i:1", b'["geek"]', None)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        self.set_valid_auth(request)
+        catalog, scoring.interests_catalog = scoring.interests_catalog, interests.Catalog()
+        try:
+            response, code = api.method_handler({"body": request, "headers": self.headers}, self.context, backend)
+        finally:
+            scoring.interests_catalog = catalog
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response[1], ["geek"])
+        self.assertEqual(sorted(response[2]), ["books", "tv"])
+
+        arguments = {"phone": "79175002042", "email": "memory@otus.ru"}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+        self.set_valid_auth(request)
+        scoring.local_cache.delete(scoring.score_key(arguments["phone"]))
+        response, code = api.method_handler({"body": request, "headers": self.headers}, self.context, backend)
+        self.assertEqual((api.OK, 3.0), (code, response["score"]))
+        self.assertEqual(backend.get(scoring.score_key(arguments["phone"])), 3.0)
+
+    def test_batch_request(self):
+        requests = [
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"first_name": "a", "last_name": "b"}},
+            {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+             "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {"phone": "1"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "bad", "arguments": {}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "unknown", "arguments": {}},
+            "online_score",
+        ]
+        for request in requests[:4] + requests[5:6]:
+            self.set_valid_auth(request)
+        response, code = api.batch_handler({"body": requests, "headers": self.headers}, self.context, self.settings)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([r["code"] for r in response],
+                         [api.OK, api.OK, api.OK, api.INVALID_REQUEST, api.FORBIDDEN, api.NOT_FOUND,
+                          api.INVALID_REQUEST])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+        self.assertEqual(response[1]["response"], {"score": 0.5})
+        self.assertEqual(response[2]["response"], {"score": 42})
+        self.assertEqual(self.context["nrequests"], len(requests))
+
+    def test_batch_item_failure(self):
+        requests = [
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+             "arguments": {"client_ids": [1]}},
+        ]
+        for request in requests:
+            self.set_valid_auth(request)
+        catalog, scoring.interests_catalog = scoring.interests_catalog, interests.Catalog()
+        try:
+            # the catalog of an empty store is empty, interests are unavailable
+            response, code = api.batch_handler({"body": requests, "headers": self.headers}, self.context,
+                                               store.MemoryBackend())
+        finally:
+            scoring.interests_catalog = catalog
+        self.assertEqual(api.OK, code)
+        self.assertEqual([r["code"] for r in response], [api.OK, api.INTERNAL_ERROR])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+
+    @cases([{}, "online_score", [{}] * (api.MAX_BATCH_SIZE + 1)])
+    def test_invalid_batch_request(self, requests):
+        _, code = api.batch_handler({"body": requests, "headers": self.headers}, self.context, self.settings)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class TestThreadingServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = api.ThreadingHTTPServer(("127.0.0.1", 0), api.MainHTTPHandler)
+        cls.port = cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, conn, body):
+        conn.request("POST", "/method/", body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        return resp, json.loads(resp.read())
+
+    def test_keep_alive(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        sockets = set()
+        for _ in range(3):
+            resp, data = self.post(conn, json.dumps({"login": "h&f"}))
+            self.assertEqual(api.INVALID_REQUEST, data["code"])
+            self.assertIsNone(resp.getheader("Connection"))
+            self.assertIsNotNone(resp.getheader("Content-Length"))
+            sockets.add(conn.sock)
+        self.assertEqual(len(sockets), 1)
+
+    def test_pipelining(self):
+        body = json.dumps({"login": "h&f"}).encode()
+        request = (b"POST /method/ HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % len(body)) + body
+        with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+            sock.sendall(request * 3)
+            received = b""
+            while received.count(b"HTTP/1.1 422") < 3:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+        self.assertEqual(received.count(b"HTTP/1.1 422"), 3)
+
+    def test_max_requests(self):
+        max_requests = api.MainHTTPHandler.max_requests
+        api.MainHTTPHandler.max_requests = 2
+        try:
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            resp, _ = self.post(conn, json.dumps({}))
+            self.assertIsNone(resp.getheader("Connection"))
+            resp, _ = self.post(conn, json.dumps({}))
+            self.assertEqual("close", resp.getheader("Connection"))
+        finally:
+            api.MainHTTPHandler.max_requests = max_requests
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.admission = api.MainHTTPHandler.admission
+
+    def tearDown(self):
+        api.MainHTTPHandler.admission = self.admission
+
+    def test_rate_limited(self):
+        api.MainHTTPHandler.admission = ratelimit.Admission(login_rate=0.001, burst=1, max_client_ids=2,
+                                                            authenticate=api.check_token)
+        request = {"account": "horns&hoofs", "login": "limited", "method": "online_score", "token": "forged",
+                   "arguments": {}}
+        # requests with a wrong token are answered 403 without spending the quota of the login
+        for _ in range(2):
+            code, payload = api.MainHTTPHandler.process("/method/", {}, json.dumps(request).encode())
+            self.assertEqual(api.FORBIDDEN, code)
+        request["token"] = api.user_digest(request["account"], request["login"])
+        body = json.dumps(request).encode()
+        code, payload = api.MainHTTPHandler.process("/method/", {}, body)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        # rejected before validation
+        code, payload = api.MainHTTPHandler.process("/method/", {}, body)
+        self.assertEqual(api.TOO_MANY_REQUESTS, code)
+        self.assertEqual("Rejected by login limit", json.loads(payload)["error"])
+        body = json.dumps({"login": "other", "arguments": {"client_ids": [1, 2, 3]}}).encode()
+        code, payload = api.MainHTTPHandler.process("/method/", {}, body)
+        self.assertEqual(api.TOO_MANY_REQUESTS, code)
+        self.assertIn('scoring_api_rejected_total{reason="login"} 1', api.metrics.REGISTRY.render().decode())
+
+
+class CountingBackend(store.MemoryBackend):
+    calls = 0
+
+    def interests(self, keys, catalog, sync=True, deadline=None):
+        self.calls += 1
+        return super().interests(keys, catalog, sync, deadline)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.backend = CountingBackend()
+        self.backend.set(interests.LIST_KEY, "cars,pets,travel,books", None)
+        self.backend.set("i:1", b'["geek"]', None)
+        self.handler = api.HANDLERS["clients_interests"]
+        self.previous = api.MainHTTPHandler.store, scoring.interests_catalog
+        api.MainHTTPHandler.store, scoring.interests_catalog = self.backend, interests.Catalog()
+
+    def tearDown(self):
+        api.MainHTTPHandler.store, scoring.interests_catalog = self.previous
+        self.handler.responses = None
+
+    def request(self, client_ids, headers=None):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                "arguments": {"client_ids": client_ids, "date": "20.07.2017"}}
+        body["token"] = api.user_digest(body["account"], body["login"])
+        code, response_headers, payload = api.MainHTTPHandler.dispatch("POST", "/method/", headers or {},
+                                                                      json.dumps(body).encode())
+        return code, dict(response_headers).get("ETag"), payload
+
+    def test_deterministic(self):
+        code, etag, payload = self.request([1, 2, 3])
+        self.assertEqual(api.OK, code)
+        self.assertEqual(json.loads(payload)["response"]["1"], ["geek"])
+        self.assertEqual(self.request([3, 2, 1])[1], etag)
+        self.assertEqual(list(json.loads(self.request([3, 1, 2, 1])[2])["response"]), ["1", "2", "3"])
+        self.assertEqual(etag, '"%s"' % hashlib.md5(payload).hexdigest())
+        self.assertEqual(self.request([1, 2, 3]), (code, etag, payload))
+        self.assertEqual(self.backend.calls, 4)
+
+    def test_not_modified(self):
+        self.handler.responses = api.cache.LRUCache(ttl=60)
+        code, etag, payload = self.request([1, 2])
+        self.assertEqual(self.backend.calls, 1)
+        code, second, payload = self.request([2, 1, 2], {"If-None-Match": etag})
+        self.assertEqual((api.NOT_MODIFIED, etag, b""), (code, second, payload))
+        # answered from the response cache without the store
+        self.assertEqual(self.backend.calls, 1)
+        code, _, payload = self.request([1, 2], {"If-None-Match": '"other"'})
+        self.assertEqual(api.OK, code)
+        self.assertEqual(self.backend.calls, 1)
+        self.request([1, 3])
+        self.assertEqual(self.backend.calls, 2)
+
+
+class TestGracefulShutdown(unittest.TestCase):
+    def setUp(self):
+        self.dispatch = api.MainHTTPHandler.__dict__["dispatch"]
+        self.answered = []
+
+        def slow(cls, command, path, headers, data_string):
+            time.sleep(0.3)
+            self.answered.append(path)
+            return api.OK, [], b"{}"
+
+        api.MainHTTPHandler.dispatch = classmethod(slow)
+
+    def tearDown(self):
+        api.MainHTTPHandler.dispatch = self.dispatch
+
+    def shutdown_during_request(self, engine):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = api.make_server(Values({"port": port, "engine": engine, "threads": 2}))
+        serving = threading.Thread(target=server.serve_forever, daemon=True)
+        serving.start()
+        for _ in range(50):
+            try:
+                idle = socket.create_connection(("localhost", port))
+                break
+            except OSError:
+                time.sleep(0.02)
+        statuses = []
+
+        def client():
+            conn = HTTPConnection("localhost", port, timeout=5)
+            conn.request("POST", "/method/", body=b"{}")
+            resp = conn.getresponse()
+            resp.read()
+            statuses.append((resp.status, resp.getheader("Connection")))
+
+        requesting = threading.Thread(target=client)
+        requesting.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        server.shutdown()
+        serving.join(5)
+        server.server_close()
+        # a worker exits right after server_close, the request has to be done by then
+        self.assertEqual(self.answered, ["/method/"])
+        requesting.join(5)
+        idle.close()
+        # the request in progress is answered, the idle connection does not hold the stop
+        self.assertEqual(statuses, [(api.OK, "close")])
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_asyncio(self):
+        self.shutdown_during_request("asyncio")
+
+    def test_thread(self):
+        self.shutdown_during_request("thread")
+
+
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            cls.port = s.getsockname()[1]
+        cls.server = aioserver.AsyncHTTPServer(("127.0.0.1", cls.port), api.MainHTTPHandler.dispatch)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", cls.port)).close()
+                break
+            except OSError:
+                threading.Event().wait(0.05)
+
+    def post(self, conn, path, body):
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        return resp, json.loads(resp.read())
+
+    def test_bad_request(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        resp, data = self.post(conn, "/method/", b"{not json")
+        self.assertEqual(api.BAD_REQUEST, resp.status)
+        self.assertEqual(api.BAD_REQUEST, data["code"])
+
+    def test_keep_alive(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        for path, code in (("/method/", api.INVALID_REQUEST), ("/unknown/", api.NOT_FOUND)):
+            resp, data = self.post(conn, path, json.dumps({"login": "h&f"}))
+            self.assertEqual(code, resp.status)
+            self.assertEqual(code, data["code"])
+            self.assertEqual("keep-alive", resp.getheader("Connection"))
+
+    def test_too_large(self):
+        # only the headers are sent: the server answers without reading the body
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.putrequest("POST", "/method/")
+        conn.putheader("Content-Length", str(api.MAX_BODY_SIZE + 1))
+        conn.endheaders()
+        resp = conn.getresponse()
+        self.assertEqual(api.REQUEST_ENTITY_TOO_LARGE, resp.status)
+        self.assertEqual("close", resp.getheader("Connection"))
+
+    def test_not_implemented(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("PUT", "/method/")
+        self.assertEqual(501, conn.getresponse().status)
+
+    def test_metrics(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        self.post(conn, "/method/", json.dumps({"login": "h&f"}))
+        self.post(conn, "/random-path-1/", json.dumps({"login": "h&f"}))
+        self.post(conn, "/random-path-2/", json.dumps({"login": "h&f", "method": "random"}))
+        conn.request("GET", "/metrics")
+        resp = conn.getresponse()
+        body = resp.read().decode("utf-8")
+        self.assertEqual(api.OK, resp.status)
+        self.assertTrue(resp.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('scoring_api_stage_seconds_count{stage="validate"}', body)
+        self.assertIn('scoring_api_request_seconds_count{route="method",method="",code="422"}', body)
+        self.assertIn('scoring_api_request_seconds_count{route="other",method="",code="404"}', body)
+        self.assertNotIn("random", body)
+        self.assertIn("scoring_api_redis_pool_in_use", body)
+        conn.request("GET", "/unknown")
+        resp = conn.getresponse()
+        resp.read()
+        self.assertEqual(api.NOT_FOUND, resp.status)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,6 +5,8 @@ from time import sleep
 
 import redis
 
+import interests
+import scoring
 import store
 
 redis_client = store.RedisClient()
@@ -54,6 +56,16 @@ class TestSuite(unittest.TestCase):
         sleep(3)
         self.assertEqual(self.get_cache_get(), None)
 
+    def test_cache_many(self):
+        '''
+        Проверка пакетной записи кэша
+        :return: значения для записанных ключей, None для отсутствующих
+        '''
+        mapping = {'test_cache_many:1': 1.5, 'test_cache_many:2': 3.0}
+        self.assertTrue(store.cache_set_many(self.conn.conn, mapping, 3))
+        getter = [store.cache_get(self.conn.conn, key) for key in list(mapping) + ['test_cache_many:3']]
+        self.assertEqual(getter, [1.5, 3.0, None])
+
     def test_get(self):
         '''
         Проверка функции формирования интересов пользователя
@@ -65,6 +77,140 @@ class TestSuite(unittest.TestCase):
         match = re.match(pattern, getter)
         self.assertEqual(match.endpos, leng)
 
+    def test_get_many(self):
+        '''
+        Проверка пакетного получения интересов: сохраненное значение клиента
+        возвращается как есть, для остальных - выборка из list:interests
+        :return: list(интересы) на каждый ключ
+        '''
+        self.conn.conn.set('i:test_many', '["books", "tv"]', ex=3)
+        keys = ['i:test_many', 'i:test_missing', 'i:test_missing2']
+        getter = store.get_many(self.conn.conn, keys, interests.Catalog(), batch_size=2)
+        self.assertEqual(len(getter), len(keys))
+        self.assertEqual(getter[0], ["books", "tv"])
+        for value in getter[1:]:
+            self.assertEqual(len(value), 2)
+
+    def test_cache_many_ttl(self):
+        '''
+        Проверка пакетного чтения значений вместе с оставшимся временем жизни
+        :return: list((значение, ttl))
+        '''
+        store.cache_set_many(self.conn.conn, {'test_ttl:1': 1.5, 'test_ttl:2': 3.0}, 3, {'test_ttl:2': 10})
+        getter = store.cache_get_many_ttl(self.conn.conn, ['test_ttl:1', 'test_ttl:2', 'test_ttl:3'], batch_size=2)
+        self.assertEqual([value for value, ttl in getter], [1.5, 3.0, None])
+        self.assertTrue(0 < getter[0][1] <= 3 < getter[1][1] <= 10)
+        self.assertIsNone(getter[2][1])
+        # the expiry travels in the value, the reads need no PTTL
+        self.assertEqual(self.conn.conn.get('test_ttl:1').split(b'|')[0], b'1.5')
+        self.conn.conn.set('test_ttl:3', 2.0, ex=3)
+        self.assertEqual(store.cache_get_ttl(self.conn.conn, 'test_ttl:3'), (2.0, None))
+
+    def test_stale_while_revalidate(self):
+        '''
+        Проверка отдачи устаревшего скоринга: пока идет фоновый пересчет,
+        возвращается старое значение, затем в Redis записывается новое со сроком soft + stale
+        :return: float(скоринг)
+        '''
+        args = ('79175002041', 'swr@otus.ru')
+        key = scoring.score_key(args[0])
+        store.cache_set(self.conn.conn, key, 1.0, 30)
+        scoring.local_cache.delete(key)
+        self.assertEqual(scoring.get_score(*args), 1.0)
+        for _ in range(100):
+            if scoring.refresh_flights.stats()['in_flight'] == 0:
+                break
+            sleep(0.01)
+        self.assertEqual(store.cache_get(self.conn.conn, key), 3.0)
+        self.assertGreater(self.conn.conn.ttl(key), 3000)
+        self.assertEqual(scoring.get_score(*args), 3.0)
+        self.conn.conn.delete(key)
+
+    def test_interests_catalog(self):
+        '''
+        Проверка каталога интересов: список читается из Redis один раз,
+        повторно - только после смены версии; интересы клиента хранятся битовой маской
+        :return: list(интересы) клиента
+        '''
+        conn = self.conn.conn
+        catalog = interests.Catalog(refresh_interval=0)
+        store.get_many(conn, ['i:test_catalog'], catalog)
+        store.get_many(conn, ['i:test_catalog'], catalog)
+        self.assertEqual(catalog.reloads, 1 if conn.get(interests.VERSION_KEY) else 2)
+        names = list(catalog.snapshot.names)
+        interests.set_client(conn, catalog, 'i:test_catalog', [names[2], names[0]], period=3)
+        self.assertTrue(conn.get('i:test_catalog').startswith(b'#'))
+        self.assertEqual(store.get_many(conn, ['i:test_catalog'], catalog), [[names[0], names[2]]])
+        reloads = catalog.reloads
+        interests.set_client(conn, catalog, 'i:test_catalog', [names[1], 'test-interest'], period=3)
+        self.assertEqual(catalog.snapshot.names[:len(names)], tuple(names))
+        stale = interests.Catalog(refresh_interval=60)
+        stale.snapshot = stale.snapshot._replace(names=tuple(names))
+        stale.checked = time.monotonic()
+        self.assertEqual(store.get_many(conn, ['i:test_catalog'], stale), [[names[1], 'test-interest']])
+        self.assertGreater(catalog.reloads, reloads)
+        conn.set(interests.LIST_KEY, ','.join(names))
+
+    def test_warm_up(self):
+        '''
+        Проверка прогрева: соединения пула открываются до первого запроса
+        :return: количество открытых соединений
+        '''
+        backend = store.RedisBackend(max_connections=3, idle_timeout=60)
+        self.assertEqual(backend.warm_up(5), 3)
+        stats = backend.stats()['pool']
+        self.assertEqual((stats['created'], stats['idle'], stats['in_use']), (3, 3, 0))
+
+    def test_take_tokens(self):
+        '''
+        Проверка общего для всех процессов token bucket в Redis
+        :return: bool(запрос пропущен)
+        '''
+        self.conn.conn.delete('rl:test_tokens', 'rl:test_tokens2')
+        bucket = [('test_tokens', 100, 2, 1)]
+        taken = [store.take_tokens(self.conn.conn, bucket) for _ in range(3)]
+        self.assertEqual(taken, [None, None, 0])
+        sleep(0.02)
+        self.assertIsNone(store.take_tokens(self.conn.conn, bucket))
+        self.assertGreater(self.conn.conn.pttl('rl:test_tokens'), 0)
+        # tokens are taken from every bucket or from none
+        self.assertEqual(store.take_tokens(self.conn.conn, [('test_tokens2', 0.001, 1, 1), ('test_tokens', 100, 2, 5)]), 1)
+        self.assertIsNone(store.take_tokens(self.conn.conn, [('test_tokens2', 0.001, 1, 1)]))
+
+    def test_deadline(self):
+        '''
+        Проверка срока запроса: на время вызова таймаут сокета берется из остатка срока,
+        после вызова соединение возвращается в пул с обычным таймаутом
+        :return: значение из Redis, DeadlineExceeded после истечения срока
+        '''
+        key = 'uid:test_deadline'
+        backend = store.RedisBackend(max_connections=1)
+        backend.set(key, 2.5, 5, deadline=store.Deadline(1))
+        self.assertEqual(backend.get(key, deadline=store.Deadline(1)), 2.5)
+        connection = backend.pool.get_connection()
+        self.assertEqual(connection._sock.gettimeout(), backend._timeout)
+        backend.pool.release(connection)
+        with self.assertRaises(store.DeadlineExceeded):
+            backend.get(key, deadline=store.Deadline(0))
+
+    def test_pool_stats(self):
+        '''
+        Проверка ограниченного пула соединений и его счетчиков:
+        при исчерпании пула запрос ждет не дольше pool_timeout
+        :return: StoreUnavailable, счетчики занятых/свободных соединений
+        '''
+        client = store.RedisClient(max_connections=1, pool_timeout=0.01, idle_timeout=60)
+        client.call(store.cache_get, self.key)
+        connection = client.pool.get_connection()
+        self.assertEqual(client.stats()['pool']['in_use'], 1)
+        with self.assertRaises(store.StoreUnavailable):
+            client.call(store.cache_get, self.key)
+        client.pool.release(connection)
+        stats = client.stats()
+        self.assertEqual(stats['breaker'], store.CLOSED)
+        self.assertEqual((stats['pool']['in_use'], stats['pool']['idle']), (0, 1))
+        self.assertEqual((stats['pool']['created'], stats['pool']['timeouts']), (1, 1))
+
     def test_not_conn_exist(self):
         '''
         Проверка недоступености Redis
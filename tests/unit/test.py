@@ -1,9 +1,26 @@
+import io
+import os
+import sys
+import time
+import threading
 import hashlib
 import datetime
 import functools
+import socket
+import logging
 import unittest
+import subprocess
 
 import api
+import asynclog
+import cache
+import codec
+import interests
+import metrics
+import ratelimit
+import scoring
+import singleflight
+import store
 
 
 def cases(cases):
@@ -145,6 +162,25 @@ class TestBirthday(unittest.TestCase):
             f.parse_validate(birthday)
 
 
+class TestParseDate(unittest.TestCase):
+    def test_same_as_strptime(self):
+        for value in ['27.02.2009', '29.02.2000', '01.01.0001', '1.2.2009', '1.02.2009']:
+            self.assertEqual(api.parse_date(value), datetime.datetime.strptime(value, "%d.%m.%Y"))
+
+    def test_same_errors_as_strptime(self):
+        for value in ['29.02.2001', '31.04.2009', '02.27.2009', '27.02.09', '00.01.2009', '1a.02.2009', '01.02.2009 ', '',
+                      '０１.０２.２００９']:
+            with self.assertRaises(ValueError) as expected:
+                datetime.datetime.strptime(value, "%d.%m.%Y")
+            with self.assertRaises(ValueError) as parsed:
+                api.parse_date(value)
+            self.assertEqual(str(parsed.exception), str(expected.exception))
+
+    def test_today(self):
+        self.assertEqual(api.today().date(), datetime.date.today())
+        self.assertIs(api.today(), api.today())
+
+
 class TestGenderField(unittest.TestCase):
     @cases([1,
             2,
@@ -183,5 +219,605 @@ class TestClientId(unittest.TestCase):
             f.parse_validate(clientid)
 
 
+class TestRequest(unittest.TestCase):
+    def test_slots(self):
+        r = api.ClientsInterestsRequest({"client_ids": [1, 2]})
+        self.assertTrue(r.is_valid())
+        self.assertEqual(r.client_ids, [1, 2])
+        self.assertEqual(r.date, "")
+        self.assertFalse(hasattr(r, "__dict__"))
+
+    def test_errors(self):
+        r = api.MethodRequest({"login": "h&f", "token": "", "arguments": {}, "method": ""})
+        self.assertFalse(r.is_valid())
+        self.assertFalse(r.is_valid())
+        self.assertEqual(r.errfmt(), "Error in method. Required field must be non-nullable ")
+        r = api.ClientsInterestsRequest({"date": 1})
+        self.assertFalse(r.is_valid())
+        self.assertEqual(r.errfmt(), "Error in client_ids. This is Required field., "
+                                     "Error in validate field: date. This is the incorrect date string format. "
+                                     "It should be DD.MM.YYYY")
+
+
+class TestHandlerRegistry(unittest.TestCase):
+    def test_registered(self):
+        self.assertIsInstance(api.HANDLERS["online_score"], api.OnlineScoreHandler)
+        self.assertIsInstance(api.HANDLERS["clients_interests"], api.ClientsInterestsHandler)
+        self.assertEqual(api.HANDLERS["online_score"].method, "online_score")
+
+    def test_dispatch(self):
+        @api.register("test_echo", rate_limit=10, timeout=0.5)
+        class EchoHandler(api.RequestHandler):
+            request_type = api.Request
+
+            def handle(self, request, arguments, ctx, store):
+                return {"handler": id(self)}, api.OK
+
+        try:
+            handler = api.HANDLERS["test_echo"]
+            self.assertEqual((handler.rate_limit, handler.timeout), (10, 0.5))
+            body = {"account": "horns&hoofs", "login": "h&f", "method": "test_echo", "arguments": {}}
+            body["token"] = api.user_digest(body["account"], body["login"])
+            for _ in range(2):
+                response, code = api.method_handler({"body": body, "headers": {}}, {}, None)
+                self.assertEqual((response, code), ({"handler": id(handler)}, api.OK))
+        finally:
+            del api.HANDLERS["test_echo"]
+
+
+class TestCheckAuth(unittest.TestCase):
+    def make_request(self, login, token):
+        r = api.MethodRequest({"account": "horns&hoofs", "login": login, "token": token,
+                               "method": "online_score", "arguments": {}})
+        r.is_valid()
+        return r
+
+    def test_auth(self):
+        token = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode("utf-8")).hexdigest()
+        self.assertTrue(api.check_auth(self.make_request("h&f", token)))
+        admin_token = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") +
+                                      api.ADMIN_SALT).encode("utf-8")).hexdigest()
+        self.assertTrue(api.check_auth(self.make_request(api.ADMIN_LOGIN, admin_token)))
+
+    @cases(["", "токен", "sdd"])
+    def test_bad_auth(self, token):
+        self.assertFalse(api.check_auth(self.make_request("h&f", token)))
+        self.assertFalse(api.check_auth(self.make_request(api.ADMIN_LOGIN, token)))
+
+
+class TestCodec(unittest.TestCase):
+    @cases(list(codec.CODECS))
+    def test_codec(self, name):
+        try:
+            c = codec.get_codec(name)
+        except ValueError:
+            return
+        payload = c.dumps({"response": {1: ["books", "tv"]}, "code": 200})
+        self.assertIsInstance(payload, bytes)
+        self.assertEqual(c.loads(payload), {"response": {"1": ["books", "tv"]}, "code": 200})
+
+    def test_auto(self):
+        self.assertIsInstance(codec.get_codec(), codec.JSONCodec)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_hit_miss(self):
+        c = cache.LRUCache(maxsize=2, ttl=60)
+        self.assertIsNone(c.get("uid:1"))
+        c.set("uid:1", 3.0)
+        self.assertEqual(c.get("uid:1"), 3.0)
+        self.assertEqual(c.stats(), {"size": 1, "hits": 1, "misses": 1, "evictions": 0})
+
+    def test_lru_eviction(self):
+        c = cache.LRUCache(maxsize=2, ttl=60)
+        c.set("uid:1", 1.0)
+        c.set("uid:2", 2.0)
+        c.get("uid:1")
+        c.set("uid:3", 3.0)
+        self.assertIsNone(c.get("uid:2"))
+        self.assertEqual(c.get("uid:1"), 1.0)
+        self.assertEqual(c.evictions, 1)
+
+    def test_ttl(self):
+        c = cache.LRUCache(maxsize=2, ttl=60)
+        c.set("uid:1", 1.0, ttl=0.01)
+        c.set("uid:2", 2.0, ttl=0)
+        time.sleep(0.02)
+        self.assertIsNone(c.get("uid:1"))
+        self.assertIsNone(c.get("uid:2"))
+
+
+class TestCachePolicy(unittest.TestCase):
+    def test_ttls(self):
+        policy = cache.CachePolicy(ttl=3600, jitter=0.1, stale=60)
+        for _ in range(100):
+            soft, hard = policy.ttls()
+            self.assertTrue(3240 <= soft <= 3960)
+            self.assertEqual(hard, soft + 60)
+        self.assertGreater(len({policy.ttls() for _ in range(100)}), 1)
+
+    def test_state(self):
+        policy = cache.CachePolicy(ttl=3600, stale=60, beta=1.0)
+        self.assertEqual(policy.state(None), cache.FRESH)
+        self.assertEqual(policy.state(60), cache.STALE)
+        self.assertEqual(policy.state(30), cache.STALE)
+        self.assertEqual(policy.state(3000), cache.FRESH)
+        policy.delta = 1000
+        self.assertEqual(policy.state(60.001), cache.EARLY)
+        # a key computed here uses its own recompute time, others the latest one
+        policy.record("uid:slow", 1000)
+        policy.record("uid:fast", 0)
+        self.assertEqual(policy.state(60.001, "uid:slow"), cache.EARLY)
+        self.assertEqual(policy.state(60.001, "uid:fast"), cache.FRESH)
+        self.assertEqual(policy.state(60.001, "uid:other"), cache.FRESH)
+        policy.record("uid:slow", 1000)
+        self.assertEqual(policy.state(60.001, "uid:other"), cache.EARLY)
+        policy.beta = 0
+        self.assertEqual(policy.state(60.001), cache.FRESH)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry(buckets=(0.001, 0.01))
+        registry.observe("latency_seconds", (("stage", "auth"),), 0.0005)
+        registry.observe("latency_seconds", (("stage", "auth"),), 0.005)
+        registry.observe("latency_seconds", (("stage", "auth"),), 1)
+        registry.collectors.append(lambda: [("hits_total", "counter", [("hits_total", (), 3)])])
+        self.assertEqual(registry.render().decode("utf-8").splitlines(), [
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{stage="auth",le="0.001"} 1',
+            'latency_seconds_bucket{stage="auth",le="0.01"} 2',
+            'latency_seconds_bucket{stage="auth",le="+Inf"} 3',
+            'latency_seconds_sum{stage="auth"} 1.0055',
+            'latency_seconds_count{stage="auth"} 3',
+            '# TYPE hits_total counter',
+            'hits_total 3',
+        ])
+
+    def test_disabled(self):
+        registry = metrics.Registry()
+        registry.enabled = False
+        registry.observe("latency_seconds", (), 0.1)
+        self.assertEqual(registry.render(), b"\n")
+
+
+class TestInterestsCatalog(unittest.TestCase):
+    def setUp(self):
+        names = ("cars", "pets", "travel", "books")
+        self.catalog = interests.Catalog()
+        self.catalog.snapshot = interests.Snapshot(b"1", names, {name: i for i, name in enumerate(names)})
+
+    def test_encode(self):
+        self.assertEqual(self.catalog.encode(["cars", "travel"]), b"#5")
+        self.assertEqual(self.catalog.encode([]), b"#0")
+        with self.assertRaises(KeyError):
+            self.catalog.encode(["unknown"])
+
+    def test_decode(self):
+        self.assertEqual(self.catalog.decode(b"#5"), ["cars", "travel"])
+        self.assertEqual(self.catalog.decode(self.catalog.encode(["books", "pets"])), ["pets", "books"])
+        self.assertEqual(self.catalog.decode(b'["tv", "geek"]'), ["tv", "geek"])
+        sample = self.catalog.decode(None, key="i:1")
+        self.assertEqual(len(set(sample)), 2)
+        self.assertTrue(set(sample) <= set(self.catalog.snapshot.names))
+
+    def test_pick(self):
+        names = self.catalog.snapshot.names
+        self.assertEqual(interests.pick(names, "i:1"), interests.pick(names, "i:1"))
+        picks = {tuple(interests.pick(names, "i:%s" % cid)) for cid in range(100)}
+        self.assertTrue(all(a != b for a, b in picks))
+        self.assertGreater(len(picks), 6)
+        self.assertEqual(interests.pick(("cars",), "i:1"), ["cars"])
+        self.assertEqual(interests.pick((), "i:1"), [])
+
+
+class TestSingleFlight(unittest.TestCase):
+    def run_concurrently(self, group, func, n=5):
+        results = []
+
+        def call():
+            try:
+                results.append(group.do("uid:1", func))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        group, calls = singleflight.Group(), []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 3.0
+
+        self.assertEqual(self.run_concurrently(group, compute), [3.0] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(group.stats(), {"in_flight": 0, "shared": 4})
+        self.assertEqual(group.do("uid:1", compute), 3.0)
+        self.assertEqual(len(calls), 2)
+
+    def test_error(self):
+        group = singleflight.Group()
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError("store error")
+
+        results = self.run_concurrently(group, fail)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(isinstance(e, ValueError) for e in results))
+        self.assertEqual(group.stats()["in_flight"], 0)
+
+
+    def test_timeout(self):
+        group, calls = singleflight.Group(), []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 3.0
+
+        leader = threading.Thread(target=group.do, args=("uid:1", compute))
+        leader.start()
+        time.sleep(0.01)
+        started = time.monotonic()
+        # the follower gives up waiting and runs on its own
+        self.assertEqual(group.do("uid:1", lambda: 1.5, timeout=0.01), 1.5)
+        self.assertLess(time.monotonic() - started, 0.05)
+        leader.join()
+        self.assertEqual(len(calls), 1)
+
+
+class UnavailableBackend(store.MemoryBackend):
+    def get_many_ttl(self, keys, deadline=None):
+        raise store.StoreUnavailable("down")
+
+    def take_tokens(self, buckets, deadline=None):
+        raise store.StoreUnavailable("down")
+
+    def set_many(self, mapping, ttl, ttls=None, deadline=None):
+        raise store.StoreUnavailable("down")
+
+
+class TestBackends(unittest.TestCase):
+    def test_score_encoding(self):
+        score, ttl = store.decode_score(store.encode_score(1.5, 60).encode())
+        self.assertTrue(score == 1.5 and 59 < ttl <= 60.001)
+        # values written without a TTL, or before the expiry was stored with them
+        self.assertEqual(store.decode_score(str(store.encode_score(3.0, None)).encode()), (3.0, None))
+        self.assertEqual(store.decode_score(b"3.0"), (3.0, None))
+
+    def test_memory(self):
+        backend = store.MemoryBackend(maxsize=2)
+        backend.set("uid:1", 1.5, 60)
+        backend.set("uid:2", 3.0, None)
+        self.assertEqual(backend.get("uid:1"), 1.5)
+        value, ttl = backend.get_ttl("uid:1")
+        self.assertTrue(value == 1.5 and 59 < ttl <= 60)
+        self.assertEqual(backend.get_ttl("uid:2"), (3.0, None))
+        backend.set_many({"uid:3": 0.5}, 60, {"uid:3": 0.01})
+        self.assertIsNone(backend.get("uid:1"))
+        time.sleep(0.02)
+        self.assertEqual(backend.get_many_ttl(["uid:2", "uid:3"]), [(3.0, None), (None, None)])
+
+    def test_memory_interests(self):
+        catalog = interests.Catalog()
+        with self.assertRaises(store.StoreUnavailable):
+            store.MemoryBackend().interests(["i:1"], catalog)
+        backend = store.MemoryBackend(names=["cars", "pets", "travel"])
+        backend.set("i:2", b"#5", None)
+        picked, stored = backend.interests(["i:1", "i:2"], interests.Catalog())
+        self.assertEqual(len(set(picked)), 2)
+        self.assertEqual(stored, ["cars", "travel"])
+
+    def test_newer_list(self):
+        backend = store.MemoryBackend(names=["cars", "pets"])
+        catalog = interests.Catalog()
+        backend.interests(["i:1"], catalog)
+        backend.load_interests(["cars", "pets", "travel"])
+        backend.set("i:1", b"#5", None)
+        # the bit of "travel" is unknown until the catalog syncs
+        self.assertEqual(backend.interests(["i:1"], catalog), [["cars"]])
+        self.assertEqual(backend.interests(["i:1"], catalog), [["cars", "travel"]])
+
+    def test_sharded(self):
+        shards = [store.MemoryBackend(name) for name in ("a", "b", "c")]
+        backend = store.ShardedBackend(shards)
+        keys = ["uid:%s" % i for i in range(300)]
+        backend.set_many({key: i for i, key in enumerate(keys)}, 60)
+        self.assertTrue(all(80 < shard.stats()["keys"] < 120 for shard in shards))
+        self.assertEqual([value for value, ttl in backend.get_many_ttl(keys)], list(map(float, range(300))))
+        self.assertEqual(backend.get(keys[7]), 7.0)
+        self.assertEqual(backend.shard(keys[7]).get(keys[7]), 7.0)
+        # a new shard takes keys only from the others, about a quarter of them
+        grown = store.ShardedBackend(shards + [store.MemoryBackend("d")])
+        moved = [key for key in keys if grown.shard(key) is not backend.shard(key)]
+        self.assertTrue(all(grown.shard(key).name == "d" for key in moved))
+        self.assertTrue(40 < len(moved) < 110)
+
+    def test_sharded_unavailable(self):
+        shards = [store.MemoryBackend("a"), UnavailableBackend("b")]
+        backend = store.ShardedBackend(shards)
+        keys = ["uid:%s" % i for i in range(50)]
+        self.assertFalse(backend.set_many({key: 1.0 for key in keys}, 60))
+        values = backend.get_many_ttl(keys)
+        for key, (value, ttl) in zip(keys, values):
+            self.assertEqual(value, 1.0 if backend.shard(key) is shards[0] else None)
+
+    def test_sharded_interests(self):
+        shards = [store.MemoryBackend(name) for name in ("a", "b")]
+        backend = store.ShardedBackend(shards)
+        backend.shard(interests.LIST_KEY).set(interests.LIST_KEY, "cars,pets,travel", None)
+        catalog = interests.Catalog()
+        backend.set("i:1", b"#5", None)
+        self.assertEqual(backend.interests(["i:1", "i:2"], catalog)[0], ["cars", "travel"])
+        self.assertEqual(catalog.snapshot.names, ("cars", "pets", "travel"))
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_creates_no_store(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        out = subprocess.check_output([sys.executable, "-c", "import api, scoring; print(scoring.default_backend)"],
+                                      cwd=root)
+        self.assertEqual(out.strip(), b"None")
+
+    def test_warm_up(self):
+        backend = store.MemoryBackend()
+        backend.set(interests.LIST_KEY, "cars,pets", None)
+        previous, catalog = scoring.default_backend, scoring.interests_catalog
+        scoring.interests_catalog = interests.Catalog()
+        try:
+            self.assertIs(scoring.init_store(backend), scoring.get_backend())
+            scoring.warm_up(4)
+            self.assertEqual(scoring.interests_catalog.snapshot.names, ("cars", "pets"))
+        finally:
+            scoring.default_backend, scoring.interests_catalog = previous, catalog
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_token_buckets(self):
+        buckets = ratelimit.TokenBuckets(maxsize=2)
+        self.assertEqual([buckets.take("login:h&f", 100, 3) for _ in range(4)], [True, True, True, False])
+        time.sleep(0.02)
+        self.assertTrue(buckets.take("login:h&f", 100, 3))
+        self.assertFalse(buckets.take("login:h&f", 100, 3, cost=5))
+        buckets.take("login:a", 1, 1)
+        buckets.take("login:b", 1, 1)
+        self.assertEqual(len(buckets), 2)
+
+    def test_take_many(self):
+        buckets = ratelimit.TokenBuckets()
+        self.assertIsNone(buckets.take_many([("login:h&f", 0.001, 2, 1), ("account:horns&hoofs", 0.001, 1, 1)]))
+        self.assertEqual(buckets.take_many([("login:h&f", 0.001, 2, 1), ("account:horns&hoofs", 0.001, 1, 1)]), 1)
+        # the rejected request took nothing from the login bucket
+        self.assertTrue(buckets.take("login:h&f", 0.001, 2))
+        self.assertFalse(buckets.take("login:h&f", 0.001, 2))
+
+    def test_admission(self):
+        admission = ratelimit.Admission(login_rate=0.001, account_rate=0.001, burst=2, max_client_ids=3)
+        body = {"login": "h&f", "account": "horns&hoofs", "method": "online_score"}
+        self.assertEqual([admission.admit(body) for _ in range(3)], [None, None, "login"])
+        self.assertEqual(admission.admit({"login": "other", "account": "horns&hoofs"}), "account")
+        self.assertEqual(admission.admit({"login": "third", "arguments": {"client_ids": [1, 2, 3, 4]}}), "client_ids")
+        # a batch larger than the burst passes on a full bucket and empties it
+        self.assertIsNone(admission.admit([{"login": "batch"}] * 3))
+        self.assertEqual(admission.admit([{"login": "batch"}]), "login")
+        self.assertIsNone(admission.admit({"login": ["not", "validated"]}))
+        self.assertEqual(admission.rejected, {"login": 2, "account": 1, "client_ids": 1})
+
+    def test_authenticate(self):
+        admission = ratelimit.Admission(login_rate=0.001, burst=1, authenticate=lambda item: item.get("token") == "ok")
+        self.assertEqual([admission.admit({"login": "h&f", "token": "forged"}) for _ in range(3)], [None] * 3)
+        self.assertIsNone(admission.admit({"login": "h&f", "token": "ok"}))
+        self.assertEqual(admission.admit({"login": "h&f", "token": "ok"}), "login")
+
+    def test_method_rate(self):
+        admission = ratelimit.Admission(burst=1, method_rates={"clients_interests": 0.001})
+        body = {"login": "h&f", "method": "clients_interests"}
+        self.assertEqual([admission.admit(body) for _ in range(2)], [None, "method"])
+        self.assertIsNone(admission.admit({"login": "h&f", "method": "online_score"}))
+        self.assertIsNone(admission.admit({"login": "other", "method": "clients_interests"}))
+
+    def test_concurrency(self):
+        admission = ratelimit.Admission(max_concurrency=1)
+        self.assertTrue(admission.active)
+        self.assertIsNone(admission.admit({}))
+        self.assertEqual(admission.admit({}), ratelimit.CONCURRENCY)
+        admission.release()
+        self.assertIsNone(admission.admit({}))
+
+    def test_shared_fallback(self):
+        admission = ratelimit.Admission(login_rate=0.001, burst=1, shared=UnavailableBackend(),
+                                        shared_errors=(store.StoreUnavailable,))
+        self.assertIsNone(admission.admit({"login": "h&f"}))
+        self.assertEqual(admission.admit({"login": "h&f"}), "login")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_states(self):
+        breaker = store.CircuitBreaker(failure_threshold=2, reset_timeout=0.01)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure())
+        self.assertEqual(breaker.state, store.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.half_open())
+        time.sleep(0.02)
+        self.assertTrue(breaker.half_open())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, store.OPEN)
+        time.sleep(0.02)
+        breaker.half_open()
+        breaker.success()
+        self.assertEqual(breaker.state, store.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_pool_deadline(self):
+        client = store.RedisClient(port=1, max_connections=1, pool_timeout=2)
+        # the only slot of the pool is taken
+        held = client.pool.pool.get_nowait()
+        started = time.monotonic()
+        with self.assertRaises(store.DeadlineExceeded):
+            client.call(store.cache_get, "uid:1", deadline=store.Deadline(0.05))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(client.stats()["pool"]["timeouts"], 1)
+        self.assertEqual(client.breaker.failures, 0)
+        client.pool.pool.put_nowait(held)
+
+    def test_unavailable_client(self):
+        client = store.RedisClient(port=1, failure_threshold=2)
+        for _ in range(2):
+            with self.assertRaises(store.StoreUnavailable):
+                client.call(store.cache_get, "uid:1")
+        self.assertEqual(client.breaker.state, store.OPEN)
+        # failed connects are released by redis-py without having been checked out
+        stats = client.stats()["pool"]
+        self.assertEqual((stats["in_use"], stats["created"], stats["destroyed"]), (0, 0, 0))
+        self.assertIsNone(client.conn)
+        started = time.monotonic()
+        with self.assertRaises(store.StoreUnavailable):
+            client.call(store.cache_get, "uid:1")
+        self.assertLess(time.monotonic() - started, 0.01)
+
+
+class TestDeadline(unittest.TestCase):
+    def setUp(self):
+        # accepts connections and never answers
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.backend = store.RedisBackend(host="127.0.0.1", port=self.server.getsockname()[1], failure_threshold=1)
+        scoring.local_cache.clear()
+
+    def tearDown(self):
+        self.backend.pool.disconnect()
+        self.server.close()
+
+    def test_earliest(self):
+        deadline = store.Deadline(1)
+        self.assertIs(store.Deadline.earliest(deadline, None), deadline)
+        self.assertIs(store.Deadline.earliest(deadline, 5), deadline)
+        self.assertLess(store.Deadline.earliest(deadline, 0.1).remaining(), 0.1)
+        self.assertLess(store.Deadline.earliest(None, 0.1).remaining(), 0.1)
+        self.assertTrue(store.Deadline(0).expired())
+
+    def test_store_call(self):
+        started = time.monotonic()
+        with self.assertRaises(store.DeadlineExceeded):
+            self.backend.get_ttl("uid:1", deadline=store.Deadline(0.05))
+        self.assertLess(time.monotonic() - started, 0.5)
+        # the budget ran out, not Redis
+        self.assertEqual(self.backend.breaker.state, store.CLOSED)
+        with self.assertRaises(store.DeadlineExceeded):
+            self.backend.get("uid:1", deadline=store.Deadline(0))
+
+    def test_degraded_score(self):
+        started = time.monotonic()
+        score = scoring.get_score("79175002040", "a@b.ru", backend=self.backend, deadline=store.Deadline(0.05))
+        self.assertEqual(score, 3.0)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_process(self):
+        previous = api.MainHTTPHandler.store
+        api.MainHTTPHandler.store = self.backend
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                "arguments": {"client_ids": [1, 2]}}
+        body["token"] = api.user_digest(body["account"], body["login"])
+        try:
+            code, payload = api.MainHTTPHandler.process("/method/", {"X-Request-Timeout": "0.05"},
+                                                        codec.JSONCodec().dumps(body))
+        finally:
+            api.MainHTTPHandler.store = previous
+        self.assertEqual(code, api.GATEWAY_TIMEOUT)
+
+    def test_request_deadline(self):
+        handler = api.MainHTTPHandler
+        self.assertIsNone(handler.request_deadline({}))
+        self.assertLess(handler.request_deadline({"X-Request-Timeout": "0.05"}).remaining(), 0.05)
+        for value in ("inf", "nan", "1e300", "-1", "61"):
+            self.assertIsNone(handler.request_deadline({"X-Request-Timeout": value}))
+        handler.request_timeout = 0.05
+        try:
+            # the header can only shorten the configured deadline
+            self.assertLess(handler.request_deadline({"X-Request-Timeout": "10"}).remaining(), 0.05)
+            self.assertLess(handler.request_deadline({"X-Request-Timeout": "bad"}).remaining(), 0.05)
+        finally:
+            handler.request_timeout = None
+
+
+class TestAsyncLog(unittest.TestCase):
+    def make_logger(self, queue_size):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(logging.Formatter("%(levelname).1s %(message)s"))
+        logger = logging.getLogger("test.asynclog.%d" % queue_size)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = asynclog.QueueHandler(queue_size)
+        logger.addHandler(handler)
+        return logger, handler, asynclog.BatchWriter(handler, [target], batch_size=2), stream
+
+    def test_batches(self):
+        logger, handler, writer, stream = self.make_logger(10)
+        context = {"code": 200}
+        logger.info("%s: %s", "method", b"body")
+        logger.info(context)
+        logger.error("Store error")
+        writer.start()
+        writer.stop()
+        self.assertEqual(stream.getvalue(), "I method: b'body'\nI {'code': 200}\nE Store error\n")
+        self.assertEqual(handler.dropped, 0)
+
+    def test_drops_when_full(self):
+        logger, handler, writer, stream = self.make_logger(2)
+        for i in range(5):
+            logger.info("record %s", i)
+        self.assertEqual(handler.dropped, 3)
+        writer.start()
+        writer.stop()
+        self.assertEqual(stream.getvalue(), "I record 0\nI record 1\n")
+
+    def test_levels(self):
+        logger, handler, writer, stream = self.make_logger(10)
+        records = []
+        target = logging.Handler(logging.ERROR)
+        target.emit = records.append
+        writer.targets.append(target)
+        logger.info("record")
+        logger.error("Store error")
+        writer.start()
+        writer.stop()
+        self.assertEqual([record.getMessage() for record in records], ["Store error"])
+
+    def test_stop(self):
+        logger, handler, writer, stream = self.make_logger(5)
+        logger.removeHandler(handler)
+        target = writer.targets[0]
+        logger.addHandler(target)
+        handler, writer = asynclog.install(logger=logger)
+        logger.info("queued")
+        asynclog.stop()
+        logger.info("direct")
+        self.assertEqual(logger.handlers, [target])
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(stream.getvalue(), "I queued\nI direct\n")
+
+    def test_log_body(self):
+        self.assertEqual(api.MainHTTPHandler.log_body(b"0123456789"), b"0123456789")
+        api.MainHTTPHandler.log_body_size = 4
+        try:
+            self.assertEqual(api.MainHTTPHandler.log_body(b"0123"), b"0123")
+            self.assertEqual(api.MainHTTPHandler.log_body(b"0123456789"), b"0123... (10 bytes)")
+        finally:
+            api.MainHTTPHandler.log_body_size = None
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file